@@ -5,10 +5,12 @@ from .base import Baseset
 from .batch import Batch, ArrayBatch, DataFrameBatch
 from .dataset import Dataset
 from .pipeline import Pipeline
+from .server import InferenceServer
 from .jointdataset import JointDataset, FullDataset
 from .dsindex import DatasetIndex, FilesIndex
 from .decorators import action, inbatch_parallel, parallel, any_action_failed, model
 from .exceptions import SkipBatchException
+from .tuning import set_concurrency_budget, get_concurrency_budget
 
 
 if sys.version_info < (3, 5):
@@ -108,7 +108,8 @@ class Baseset:
 
     def get_default_iter_params(self):
         """ Return iteration params with default values to start iteration from scratch """
-        return dict(_stop_iter=False, _start_index=0, _order=None, _n_epochs=0, _random_state=None)
+        return dict(_stop_iter=False, _start_index=0, _order=None, _full_order=None, _order_ahead=None,
+                    _ahead_state=None, _seed=None, _n_epochs=0, _random_state=None)
 
     def reset_iter(self):
         """ Clear all iteration metadata in order to start iterating from scratch """
@@ -116,15 +117,19 @@ class Baseset:
         if hasattr(self.index, 'reset_iter'):
             self.index.reset_iter()
 
-    def gen_batch(self, batch_size, shuffle=False, n_epochs=1, drop_last=False, *args, **kwargs):
+    def gen_batch(self, batch_size, shuffle=False, n_epochs=1, drop_last=False, *args,
+                  shard_id=None, num_shards=None, iter_params=None, **kwargs):
         """ Generate batches """
-        for ix_batch in self.index.gen_batch(batch_size, shuffle, n_epochs, drop_last):
+        for ix_batch in self.index.gen_batch(batch_size, shuffle, n_epochs, drop_last,
+                                             shard_id=shard_id, num_shards=num_shards, iter_params=iter_params):
             batch = self.create_batch(ix_batch, *args, **kwargs)
             yield batch
 
-    def next_batch(self, batch_size, shuffle=False, n_epochs=1, drop_last=False, iter_params=None, *args, **kwargs):
+    def next_batch(self, batch_size, shuffle=False, n_epochs=1, drop_last=False, iter_params=None, *args,
+                   shard_id=None, num_shards=None, **kwargs):
         """ Return a batch """
-        batch_index = self.index.next_batch(batch_size, shuffle, n_epochs, drop_last, iter_params)
+        batch_index = self.index.next_batch(batch_size, shuffle, n_epochs, drop_last, iter_params,
+                                            shard_id=shard_id, num_shards=num_shards)
         batch = self.create_batch(batch_index, *args, **kwargs)
         return batch
 
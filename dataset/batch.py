@@ -1,6 +1,7 @@
 """ Contains basic Batch classes """
 
 import os
+import itertools
 
 try:
     import dill
@@ -62,59 +63,105 @@ class Batch(BaseBatch):
         Return:
             a tuple of two batches
         """
-        def _make_index(data):
-            return DatasetIndex(np.arange(data.shape[0])) if data is not None and data.shape[0] > 0 else None
+        total = sum(len(batch) for batch in batches)
+        if batch_size is None or batch_size >= total:
+            ranges = [(0, total)]
+        else:
+            ranges = [(0, batch_size), (batch_size, total)]
+        new_batches = cls.merge_ranges(batches, ranges) + [None, None]
+        return new_batches[0], new_batches[1]
 
-        def _make_batch(data):
-            index = _make_index(data[0])
-            return cls(index, preloaded=tuple(data)) if index is not None else None
+    @classmethod
+    def merge_all(cls, batches, batch_size):
+        """ Merge several batches into batches of a given size in one pass
+        Args:
+            batches - a sequence of batches to merge
+            batch_size - the size of new batches
+        Return:
+            a list of batches of batch_size and a batch with the rest of data (or None if there is no data left)
+        """
+        total = sum(len(batch) for batch in batches)
+        starts = np.arange(0, total, batch_size)
+        ranges = list(zip(starts, np.minimum(starts + batch_size, total)))
+        new_batches = cls.merge_ranges(batches, ranges)
+        if len(new_batches) > 0 and len(new_batches[-1]) < batch_size:
+            return new_batches[:-1], new_batches[-1]
+        return new_batches, None
 
-        if batch_size is None:
-            break_point = len(batches)
-            last_batch_len = len(batches[-1])
-        else:
-            break_point = -1
-            last_batch_len = 0
-            cur_size = 0
-            for i, b in enumerate(batches):
-                cur_batch_len = len(b)
-                if cur_size + cur_batch_len >= batch_size:
-                    break_point = i
-                    last_batch_len = batch_size - cur_size
-                    break
-                else:
-                    cur_size += cur_batch_len
-                    last_batch_len = cur_batch_len
+    @classmethod
+    def merge_ranges(cls, batches, ranges):
+        """ Make new batches from items of several batches
+        Args:
+            batches - a sequence of batches
+            ranges - a sequence of (start, stop) positions of items in all batches taken together
+        Return:
+            a list of batches, one for each range (empty ranges are skipped)
+        """
+        lengths = np.asarray([len(batch) for batch in batches])
+        ends = np.cumsum(lengths)
+        begins = ends - lengths
+        ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+        ranges = ranges[ranges[:, 1] > ranges[:, 0]]
+        # all batches which contain the first and the last item of each range
+        first_batches = np.searchsorted(ends, ranges[:, 0], side='right')
+        last_batches = np.searchsorted(ends, ranges[:, 1], side='left')
 
         components = batches[0].components or (None,)
-        new_data = list(None for _ in components)
-        rest_data = list(None for _ in components)
-        for i, comp in enumerate(components):
-            if batch_size is None:
-                new_comp = [b.get(component=comp) for b in batches[:break_point]]
-            else:
-                b = batches[break_point]
-                last_batch_len_ = b.get_pos(None, comp, b.indices[last_batch_len - 1])
-                new_comp = [b.get(component=comp) for b in batches[:break_point]] + \
-                           [batches[break_point].get(component=comp)[:last_batch_len_ + 1]]
-            new_data[i] = cls.merge_component(comp, new_comp)
-
-            if batch_size is not None:
-                rest_comp = [batches[break_point].get(component=comp)[last_batch_len_ + 1:]] + \
-                            [b.get(component=comp) for b in batches[break_point + 1:]]
-                rest_data[i] = cls.merge_component(comp, rest_comp)
+        all_data = [[batch.get(component=comp) for comp in components] for batch in batches]
+        new_batches = []
+        for (start, stop), first, last in zip(ranges, first_batches, last_batches):
+            new_data = []
+            for i, comp in enumerate(components):
+                parts = []
+                for j in range(first, last + 1):
+                    item_start = max(start - begins[j], 0)
+                    item_stop = min(stop, ends[j]) - begins[j]
+                    parts.append(cls.slice_component(comp, all_data[j][i], item_start, item_stop,
+                                                     batches[j].indices))
+                new_data.append(cls.merge_component(comp, parts))
+            new_batches.append(cls._make_merged_batch(new_data, stop - start, batches[0].components is not None))
+        return new_batches
 
-        new_batch = _make_batch(new_data)
-        rest_batch = _make_batch(rest_data)
+    @classmethod
+    def _make_merged_batch(cls, data, size, has_components=True):
+        batch = cls(DatasetIndex(np.arange(size)))
+        # put the data directly to avoid copying it once more with load()
+        batch._data = tuple(data) if has_components else data[0]   # pylint: disable=protected-access
+        return batch
 
-        return new_batch, rest_batch
+    @classmethod
+    def slice_component(cls, component=None, data=None, start=None, stop=None, indices=None):
+        """ Return items from start to stop positions of the same component data
+        Args:
+            component - a component name
+            data - component data
+            start, stop - positions of items in the batch
+            indices - batch indices (needed for dicts which are keyed by indices)
+        """
+        _ = component
+        if data is None:
+            return None
+        elif isinstance(data, dict):
+            return {ix: data[ix] for ix in indices[start:stop]}
+        elif hasattr(data, 'iloc'):
+            return data.iloc[start:stop]
+        return data[start:stop]
 
     @classmethod
     def merge_component(cls, component=None, data=None):
         """ Merge the same component data from several batches """
         _ = component
-        if isinstance(data[0], np.ndarray):
+        if data[0] is None:
+            return None
+        elif isinstance(data[0], np.ndarray):
             return np.concatenate(data)
+        elif hasattr(data[0], 'iloc'):
+            return pd.concat(data, ignore_index=True)
+        elif isinstance(data[0], dict):
+            # new batches are indexed with positions
+            return dict(enumerate(itertools.chain(*(part.values() for part in data))))
+        elif isinstance(data[0], list):
+            return list(itertools.chain(*data))
         else:
             raise TypeError("Unknown data type", type(data[0]))
 
@@ -478,7 +525,7 @@ class Batch(BaseBatch):
         for i, comp in enumerate(components):
             setattr(self, comp, _data.iloc[:, i].values)
 
-    @action(use_lock='__dump_table_lock')
+    @action(use_lock='__dump_table_lock', lock_key='dst')
     def _dump_table(self, dst, fmt='feather', components=None, *args, **kwargs):
         """ Save batch data to table formats
         Args:
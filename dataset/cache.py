@@ -0,0 +1,278 @@
+""" Contains a cache for outputs of deterministic actions """
+import os
+import sys
+import glob
+import copy
+import uuid
+import types
+import pickle
+import hashlib
+import functools
+import threading
+import numpy as np
+
+
+def _hash_code(code, sha):
+    """ Update a hash with a bytecode, constants and names used in a code object """
+    sha.update(code.co_code)
+    sha.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(const, sha)
+        else:
+            sha.update(repr(const).encode())
+
+
+def _hash_callable(value, sha, seen):
+    """ Update a hash with a callable name and, for python functions, with their code, defaults and closure values,
+    so that a function with the same name but another body or captured values gets another hash
+    """
+    sha.update(('%s.%s' % (getattr(value, '__module__', None), getattr(value, '__qualname__', repr(value))))
+               .encode())
+    if isinstance(value, functools.partial):
+        _hash_value((value.func, value.args, value.keywords), sha, seen)
+        return
+    func = getattr(value, '__func__', value)
+    code = getattr(func, '__code__', None)
+    if not isinstance(code, types.CodeType) or id(func) in seen:
+        return
+    seen.add(id(func))
+    _hash_code(code, sha)
+    _hash_value((func.__defaults__, func.__kwdefaults__), sha, seen)
+    for cell in func.__closure__ or ():
+        try:
+            contents = cell.cell_contents
+        except ValueError:
+            # an empty cell
+            contents = None
+        _hash_value(contents, sha, seen)
+
+
+def _hash_value(value, sha, seen=None):
+    """ Update a hash with a value which might contain arrays, functions and containers """
+    seen = set() if seen is None else seen
+    if isinstance(value, np.ndarray):
+        sha.update(repr((value.shape, value.dtype.str)).encode())
+        if value.dtype.hasobject:
+            sha.update(repr(value.tolist()).encode())
+        else:
+            # a contiguous array is hashed as is without copying its bytes
+            sha.update(np.ascontiguousarray(value).reshape(-1).view(np.uint8))
+    elif isinstance(value, (list, tuple)):
+        sha.update(('%s:%d' % (type(value).__name__, len(value))).encode())
+        for item in value:
+            _hash_value(item, sha, seen)
+    elif isinstance(value, dict):
+        sha.update(('dict:%d' % len(value)).encode())
+        for key in sorted(value, key=repr):
+            _hash_value(key, sha, seen)
+            _hash_value(value[key], sha, seen)
+    elif callable(value):
+        _hash_callable(value, sha, seen)
+    else:
+        sha.update(repr(value).encode())
+
+
+def fingerprint(*values):
+    """ Return a hex digest of values (e.g. action names and their arguments) """
+    sha = hashlib.sha1()
+    for value in values:
+        _hash_value(value, sha)
+    return sha.hexdigest()
+
+
+def _nbytes(data):
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if hasattr(data, 'memory_usage'):
+        return int(data.memory_usage(deep=True).sum())
+    return sys.getsizeof(data)
+
+
+def batch_nbytes(batch):
+    """ Return the size of batch data in bytes (a sum over all components) """
+    return sum(_nbytes(batch.get(component=comp)) for comp in batch.components or (None,))
+
+
+class PrefixCache:
+    """ Store outputs of deterministic actions for each item, so that they are not recalculated in later epochs
+
+    Cached data are looked up by a key (a fingerprint of actions, their arguments and the dataset index)
+    and by item index values. A batch is rebuilt from the cache only if all its items are cached.
+
+    Args:
+        max_bytes: int or None - the maximum size of cached data (None means unlimited).
+                   When the cache is full, new batches are not cached, while cached items are still used.
+        path: str or None - a directory to keep cached data on disk instead of memory.
+              Arrays are stored as .npy files and opened memory-mapped, other data are pickled.
+              Data stored by previous runs with the same key are used as well.
+
+    Usage:
+        cache = PrefixCache(max_bytes=8 * 2**30)
+        batch = cache.get(key, batch)
+        if batch is None:
+            batch = do_something(batch)
+            cache.put(key, batch)
+    """
+    def __init__(self, max_bytes=None, path=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self._items = dict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.full = False
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """ Return a dict with the number of cache hits and misses, cached items and their size in bytes """
+        return dict(hits=self.hits, misses=self.misses, items=sum(len(items) for items in self._items.values()),
+                    nbytes=self.nbytes, full=self.full)
+
+    def clear(self):
+        """ Remove all cached data from memory (files on disk are kept) """
+        with self._lock:
+            self._items = dict()
+            self.nbytes = 0
+            self.full = False
+
+    def _get_items(self, key):
+        items = self._items.get(key)
+        if items is None:
+            with self._lock:
+                items = self._items.get(key)
+                if items is None:
+                    items = self._load_entries(key) if self.path is not None else dict()
+                    self._items[key] = items
+        return items
+
+    def get(self, key, batch):
+        """ Return a batch made of cached items or None if some items are not cached """
+        items = self._get_items(key)
+        try:
+            locations = [items[ix] for ix in batch.indices]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._make_batch(batch, locations)
+
+    def put(self, key, batch, indices=None):
+        """ Store items of a batch
+
+        Args:
+            key: str - a cache key
+            batch: a batch to store
+            indices: item indices to store the batch items under (batch indices if None).
+                     Actions might re-index a batch, while items should be found by the indices they had before.
+
+        Return:
+            True if the batch has been cached, False if the cache is full
+        """
+        components = batch.components
+        # actions executed after the cache might change data in place
+        data = [np.copy(item) if isinstance(item, np.ndarray) else copy.deepcopy(item)
+                for item in (batch.get(component=comp) for comp in components or (None,))]
+        nbytes = sum(_nbytes(item) for item in data)
+        with self._lock:
+            if self.max_bytes is not None and self.nbytes + nbytes > self.max_bytes:
+                self.full = True
+                return False
+            self.nbytes += nbytes
+
+        keys = np.asarray(batch.indices if indices is None else indices)
+        entry = dict(batch_class=type(batch), components=components, indices=np.asarray(batch.indices), keys=keys,
+                     data=data)
+        if self.path is not None:
+            self._save_entry(key, entry)
+        items = self._get_items(key)
+        with self._lock:
+            items.update((ix, (entry, pos)) for pos, ix in enumerate(entry['keys']))
+        return True
+
+    @staticmethod
+    def _make_batch(batch, locations):
+        batch_class = locations[0][0]['batch_class']
+        components = locations[0][0]['components']
+        # items from the same cached batch are copied at once
+        groups = dict()
+        for j, (entry, pos) in enumerate(locations):
+            group = groups.setdefault(id(entry), (entry, [], []))
+            group[1].append(j)
+            group[2].append(pos)
+
+        new_data = []
+        for i, comp in enumerate(components or (None,)):
+            sample = locations[0][0]['data'][i]
+            if isinstance(sample, np.ndarray):
+                data = np.empty((len(locations),) + sample.shape[1:], dtype=sample.dtype)
+                for entry, batch_pos, entry_pos in groups.values():
+                    data[batch_pos] = entry['data'][i][entry_pos]
+            else:
+                parts = [batch_class.slice_component(comp, entry['data'][i], pos, pos + 1, entry['indices'])
+                         for entry, pos in locations]
+                data = batch_class.merge_component(comp, parts)
+            new_data.append(data)
+
+        new_batch = batch_class(batch.index)
+        # put the data directly to avoid copying it once more with load()
+        # pylint: disable=protected-access
+        new_batch._data = tuple(new_data) if components is not None else new_data[0]
+        return new_batch
+
+    def _save_entry(self, key, entry):
+        """ Save entry data into files, so that they can be read by later runs """
+        dirname = os.path.join(self.path, key)
+        os.makedirs(dirname, exist_ok=True)
+        name = os.path.join(dirname, uuid.uuid4().hex)
+        for i, data in enumerate(entry['data']):
+            if isinstance(data, np.ndarray) and not data.dtype.hasobject:
+                self._write(name + '_%d.npy' % i, lambda file, data=data: np.save(file, data))
+            else:
+                self._write(name + '_%d.pkl' % i, lambda file, data=data: pickle.dump(data, file))
+        meta = dict(batch_class=entry['batch_class'], components=entry['components'], indices=entry['indices'],
+                    keys=entry['keys'], n_components=len(entry['data']))
+        # meta file goes last as it marks the entry as complete
+        self._write(name + '.meta', lambda file: pickle.dump(meta, file))
+        entry['data'] = self._read_data(name, meta['n_components'])
+
+    @staticmethod
+    def _write(filename, write_fn):
+        # write into a temporary file first so that an interrupted run leaves no broken files
+        tmp_name = filename + '.tmp'
+        with open(tmp_name, 'wb') as file:
+            write_fn(file)
+        os.replace(tmp_name, filename)
+
+    @staticmethod
+    def _read_data(name, n_components):
+        data = []
+        for i in range(n_components):
+            if os.path.isfile(name + '_%d.npy' % i):
+                data.append(np.load(name + '_%d.npy' % i, mmap_mode='r'))
+            else:
+                with open(name + '_%d.pkl' % i, 'rb') as file:
+                    data.append(pickle.load(file))
+        return data
+
+    def _load_entries(self, key):
+        """ Read entries stored by previous runs """
+        items = dict()
+        for meta_name in glob.glob(os.path.join(self.path, key, '*.meta')):
+            name = meta_name[:-len('.meta')]
+            with open(meta_name, 'rb') as file:
+                meta = pickle.load(file)
+            entry = dict(batch_class=meta['batch_class'], components=meta['components'], indices=meta['indices'],
+                         keys=meta.get('keys', meta['indices']), data=self._read_data(name, meta['n_components']))
+            self.nbytes += sum(_nbytes(item) for item in entry['data'])
+            items.update((ix, (entry, pos)) for pos, ix in enumerate(entry['keys']))
+        return items
@@ -1,6 +1,5 @@
 """ Dataset """
 
-import numpy as np
 from .base import Baseset
 from .dsindex import DatasetIndex
 from .pipeline import Pipeline
@@ -35,9 +34,9 @@ class Dataset(Baseset):
 
     @staticmethod
     def _is_same_index(index1, index2):
-        return (isinstance(index1, type(index2)) or isinstance(index2, type(index1))) and \
-               index1.indices.shape == index2.indices.shape and \
-               np.all(index1.indices == index2.indices)
+        if index1 is index2:
+            return True
+        return (isinstance(index1, type(index2)) or isinstance(index2, type(index1))) and index1.is_same(index2)
 
 
     def create_subset(self, index):
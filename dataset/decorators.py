@@ -1,19 +1,22 @@
 """ Pipeline decorators """
-import os
+import time
 import traceback
 import threading
 import concurrent.futures as cf
 import asyncio
 import functools
+import inspect
+import contextlib
+import weakref
+import numpy as np
+
+from .locks import KeyedLock
+from .tuning import WorkerTuner, cpu_count, get_concurrency_budget
+from .shm import SharedArray, is_shareable, run_chunk, get_executor as get_shm_executor
 
 
 def _workers_count():
-    cpu_count = 0
-    try:
-        cpu_count = len(os.sched_getaffinity(0))
-    except AttributeError:
-        cpu_count = os.cpu_count()
-    return cpu_count * 4
+    return cpu_count() * 4
 
 def get_method_fullname(method):
     """ Return a method name in the format module_name.class_name.func_name """
@@ -27,19 +30,54 @@ class _DummyBatch:
 
 
 _MODEL_MODES = ['global', 'static', 'dynamic']
+_NOT_FOUND = object()
+
+
+def _name_suffixes(full_name):
+    """ Return all dot-separated suffixes of a full name, e.g. 'c', 'b.c', 'a.b.c' for 'a.b.c' """
+    parts = full_name.split('.')
+    return ['.'.join(parts[i:]) for i in range(len(parts))]
 
 
 class ModelDirectory:
     """ Directory of model definition methods in Batch classes """
     models = dict(zip(_MODEL_MODES, (dict() for _ in range(len(_MODEL_MODES)))))
+    # a name suffix -> model methods with such a name (an ordered set)
+    name_index = dict()
+    # search results for each pipeline, they are dropped whenever the directory changes
+    _search_cache = weakref.WeakKeyDictionary()
+    _global_search_cache = dict()
+    # changes are made under the lock and increase the version, so that stale search results are not cached
+    _lock = threading.RLock()
+    _version = 0
+
+    @staticmethod
+    def _clear_search_cache():
+        ModelDirectory._version += 1
+        ModelDirectory._search_cache.clear()
+        ModelDirectory._global_search_cache.clear()
+
+    @staticmethod
+    def _get_search_cache(pipeline):
+        if pipeline is None:
+            return ModelDirectory._global_search_cache
+        try:
+            return ModelDirectory._search_cache.setdefault(pipeline, dict())
+        except TypeError:
+            # the pipeline cannot be weakly referenced
+            return dict()
 
     @staticmethod
     def add_model(method_spec, model_spec):
         """ Add a model specification into the model directory """
         mode, model_method, pipeline = method_spec['mode'], method_spec['method'], method_spec['pipeline']
-        if pipeline not in ModelDirectory.models[mode]:
-            ModelDirectory.models[mode][pipeline] = dict()
-        ModelDirectory.models[mode][pipeline].update({model_method: model_spec})
+        with ModelDirectory._lock:
+            if pipeline not in ModelDirectory.models[mode]:
+                ModelDirectory.models[mode][pipeline] = dict()
+            ModelDirectory.models[mode][pipeline].update({model_method: model_spec})
+            for name in _name_suffixes(method_spec['name']):
+                ModelDirectory.name_index.setdefault(name, dict())[model_method] = None
+            ModelDirectory._clear_search_cache()
 
     @staticmethod
     def equal_names(model_name, model_ref):
@@ -49,18 +87,38 @@ class ModelDirectory:
 
     @staticmethod
     def find_model_method_by_name(model_name, pipeline=None, modes=None):
-        """ Search a model method by its name """
-        model_dicts = []
-        modes = modes or _MODEL_MODES
-        for mode in modes:
-            pipe = None if mode == 'global' else pipeline
-            if pipe in ModelDirectory.models[mode]:
-                mode_models = ModelDirectory.models[mode][pipe]
-                model_dicts.append(mode_models)
+        """ Search a model method by its name
+
+        Names are looked up in the name index and the results are cached for each pipeline.
+        A full scan with `equal_names` is made only for names which are not whole dot-separated suffixes.
+        """
+        modes = tuple(modes or _MODEL_MODES)
+        key = model_name, modes
+        cache = ModelDirectory._get_search_cache(pipeline)
+        result = cache.get(key, _NOT_FOUND)
+        if result is _NOT_FOUND:
+            version = ModelDirectory._version
+            result = ModelDirectory._find_model_methods(model_name, pipeline, modes)
+            with ModelDirectory._lock:
+                if version == ModelDirectory._version:
+                    cache[key] = result
+        return result
+
+    @staticmethod
+    def _find_model_methods(model_name, pipeline, modes):
+        pipes = [(mode, None if mode == 'global' else pipeline) for mode in modes]
+        model_dicts = [ModelDirectory.models[mode][pipe] for mode, pipe in pipes if pipe in ModelDirectory.models[mode]]
+
+        name = model_name if not callable(model_name) else get_method_fullname(model_name)
+        candidates = ModelDirectory.name_index.get(name)
+        candidates = tuple(candidates) if candidates is not None else None     # it might change while searching
         models_with_same_name = []
         for mode_models in model_dicts:
-            models_with_same_name += [model_method for model_method in mode_models
-                                      if ModelDirectory.equal_names(model_name, model_method.method_spec['name'])]
+            if candidates is not None:
+                models_with_same_name += [model_method for model_method in candidates if model_method in mode_models]
+            else:
+                models_with_same_name += [model_method for model_method in tuple(mode_models)
+                                          if ModelDirectory.equal_names(name, model_method.method_spec['name'])]
         return models_with_same_name if len(models_with_same_name) > 0 else None
 
     @staticmethod
@@ -120,7 +178,17 @@ class ModelDirectory:
     def del_model(method_spec):
         """ Remove a model specification from the model directory """
         mode, model_method, pipeline = method_spec['mode'], method_spec['method'], method_spec['pipeline']
-        ModelDirectory.models[mode][pipeline].pop(model_method, None)
+        with ModelDirectory._lock:
+            ModelDirectory.models[mode][pipeline].pop(model_method, None)
+            still_used = any(model_method in mode_models
+                             for pipelines in ModelDirectory.models.values() for mode_models in pipelines.values())
+            if not still_used:
+                for name in _name_suffixes(method_spec['name']):
+                    methods = ModelDirectory.name_index.get(name, {})
+                    methods.pop(model_method, None)
+                    if len(methods) == 0:
+                        ModelDirectory.name_index.pop(name, None)
+            ModelDirectory._clear_search_cache()
 
     @staticmethod
     def delete_all_models(pipeline):
@@ -131,7 +199,7 @@ class ModelDirectory:
                 mode_models = ModelDirectory.models[mode][pipeline]
                 model_dicts.append(mode_models)
         for mode_models in model_dicts:
-            for one_model in mode_models:
+            for one_model in list(mode_models):
                 method_spec = {**one_model.method_spec, **dict(pipeline=pipeline)}
                 ModelDirectory.del_model(method_spec)
 
@@ -264,42 +332,68 @@ def model(mode='global', engine='tf'):
 
 
 
-def _make_action_wrapper_with_args(model=None, use_lock=None):    # pylint: disable=redefined-outer-name
-    return functools.partial(_make_action_wrapper, _model_name=model, _use_lock=use_lock)
+def _make_action_wrapper_with_args(model=None, use_lock=None, lock_key=None,  # pylint: disable=redefined-outer-name
+                                   lock_stripes=None):
+    return functools.partial(_make_action_wrapper, _model_name=model, _use_lock=use_lock,
+                             _lock_key=lock_key, _lock_stripes=lock_stripes)
+
+def _get_lock_key(action_signature, lock_key, action_self, args, kwargs):
+    """ Return a key for a keyed lock: a value of an action argument or a result of a callable """
+    if lock_key is None:
+        return None
+    if callable(lock_key):
+        return lock_key(action_self, *args, **kwargs)
+    arguments = action_signature.bind_partial(action_self, *args, **kwargs).arguments
+    if lock_key in arguments:
+        return arguments[lock_key]
+    param = action_signature.parameters.get(lock_key)
+    return param.default if param is not None and param.default is not param.empty else None
+
+def _get_action_lock(pipeline, lock_name, lock_stripes, key):
+    """ Return a lock stored in a pipeline variable """
+    if not pipeline.has_variable(lock_name):
+        pipeline.init_variable(lock_name, init=functools.partial(KeyedLock, lock_stripes))
+    lock = pipeline.get_variable(lock_name)
+    if isinstance(lock, KeyedLock):
+        lock = lock.get_lock(key)
+    return lock
+
+def _make_action_wrapper(action_method, _model_name=None, _use_lock=None, _lock_key=None, _lock_stripes=None):
+    action_signature = inspect.signature(action_method) if _lock_key is not None else None
 
-def _make_action_wrapper(action_method, _model_name=None, _use_lock=None):
     @functools.wraps(action_method)
     def _action_wrapper(action_self, *args, **kwargs):
         """ Call the action method """
-        if _use_lock is not None:
-            if action_self.pipeline is not None:
-                if not action_self.pipeline.has_variable(_use_lock):
-                    action_self.pipeline.init_variable(_use_lock, threading.Lock())
-                action_self.pipeline.get_variable(_use_lock).acquire()
-
-        if _model_name is None:
-            _res = action_method(action_self, *args, **kwargs)
+        if _use_lock is not None and action_self.pipeline is not None:
+            key = _get_lock_key(action_signature, _lock_key, action_self, args, kwargs)
+            lock = _get_action_lock(action_self.pipeline, _use_lock, _lock_stripes, key)
+            lock.acquire()
         else:
-            if hasattr(action_self, _model_name):
-                try:
-                    _model_method = getattr(action_self, _model_name)
-                    _ = _model_method.model_method
-                except AttributeError:
-                    raise ValueError("The method '%s' is not marked with @model" % _model_name)
-            else:
-                raise ValueError("There is no such method '%s'" % _model_name)
+            lock = None
 
-            _model_spec = _model_method()
+        try:
+            if _model_name is None:
+                _res = action_method(action_self, *args, **kwargs)
+            else:
+                if hasattr(action_self, _model_name):
+                    try:
+                        _model_method = getattr(action_self, _model_name)
+                        _ = _model_method.model_method
+                    except AttributeError:
+                        raise ValueError("The method '%s' is not marked with @model" % _model_name)
+                else:
+                    raise ValueError("There is no such method '%s'" % _model_name)
 
-            _res = action_method(action_self, _model_spec, *args, **kwargs)
+                _model_spec = _model_method()
 
-        if _use_lock is not None:
-            if action_self.pipeline is not None:
-                action_self.pipeline.get_variable(_use_lock).release()
+                _res = action_method(action_self, _model_spec, *args, **kwargs)
+        finally:
+            if lock is not None:
+                lock.release()
 
         return _res
 
-    _action_wrapper.action = dict(method=action_method, use_lock=_use_lock)
+    _action_wrapper.action = dict(method=action_method, use_lock=_use_lock, lock_key=_lock_key)
     return _action_wrapper
 
 def action(*args, **kwargs):
@@ -313,6 +407,19 @@ def action(*args, **kwargs):
         @action(model='some_model')
         def train_model(self, model, another_arg):
             ...
+
+        @action(use_lock='dump_lock', lock_key='dst')
+        def dump_to_file(self, dst):
+            # only one action at a time writes to the same dst
+            ...
+
+    Args:
+        model: str - a name of a model method which specification is passed into the action
+        use_lock: str - a name of a pipeline variable with a lock which is held while the action is executed.
+                  By default it stores a `KeyedLock`, but any lock might be put into the variable in advance.
+        lock_key: str - a name of an action argument which value selects a separate lock,
+                  or a callable which takes the batch and all action arguments and returns a key
+        lock_stripes: int - the number of locks to hash keys into (by default each key has its own lock)
     """
     if len(args) == 1 and callable(args[0]):
         # action without arguments
@@ -326,177 +433,565 @@ def any_action_failed(results):
     """ Return True if some parallelized invocations threw exceptions """
     return any(isinstance(res, Exception) for res in results)
 
-def inbatch_parallel(init, post=None, target='threads', **dec_kwargs):
-    """ Make in-batch parallel decorator """
-    if target not in ['nogil', 'threads', 'mpc', 'async', 'for', 't', 'm', 'a', 'f']:
-        raise ValueError("target should be one of 'threads', 'mpc', 'async', 'for'")
 
-    def inbatch_parallel_decorator(method):
-        """ Return a decorator which run a method in parallel """
-        def _check_functions(self):
-            """ Check dcorator's `init` and `post` parameters """
-            if init is None:
-                raise ValueError("init cannot be None")
-            else:
-                try:
-                    init_fn = getattr(self, init)
-                except AttributeError:
-                    raise ValueError("init should refer to a method or property of the class", type(self).__name__,
-                                     "returning the list of arguments")
-            if post is not None:
-                try:
-                    post_fn = getattr(self, post)
-                except AttributeError:
-                    raise ValueError("post should refer to a method of the class", type(self).__name__)
-                if not callable(post_fn):
-                    raise ValueError("post should refer to a method of the class", type(self).__name__)
-            else:
-                post_fn = None
-            return init_fn, post_fn
+class ParallelResults(list):
+    """ A list of results from parallelized invocations
 
-        def _call_init_fn(init_fn, args, kwargs):
-            if callable(init_fn):
-                return init_fn(*args, **kwargs)
-            else:
-                return init_fn
-
-        def _call_post_fn(self, post_fn, futures, args, kwargs):
-            all_results = []
-            for future in futures:
-                try:
-                    if isinstance(future, (cf.Future, asyncio.Task)):
-                        result = future.result()
-                    else:
-                        result = future
-                except Exception as exce:  # pylint: disable=broad-except
-                    result = exce
-                finally:
-                    all_results += [result]
-
-            if post_fn is None:
-                if any_action_failed(all_results):
-                    all_errors = [error for error in all_results if isinstance(error, Exception)]
-                    print(all_errors)
-                    traceback.print_tb(all_errors[0].__traceback__)
-                return self
-            else:
-                return post_fn(all_results, *args, **kwargs)
-
-        def _make_args(init_args, args, kwargs):
-            """ Make args, kwargs tuple """
-            if isinstance(init_args, tuple) and len(init_args) == 2:
-                margs, mkwargs = init_args
-            elif isinstance(init_args, dict):
-                margs = list()
-                mkwargs = init_args
-            else:
-                margs = init_args
-                mkwargs = dict()
-            margs = margs if isinstance(margs, (list, tuple)) else [margs]
-            if len(args) > 0:
-                margs = list(margs) + list(args)
-            if len(kwargs) > 0:
-                mkwargs.update(kwargs)
-            return margs, mkwargs
-
-        def wrap_with_threads(self, args, kwargs, nogil=False):
-            """ Run a method in parallel """
-            init_fn, post_fn = _check_functions(self)
-
-            n_workers = kwargs.pop('n_workers', _workers_count())
-            with cf.ThreadPoolExecutor(max_workers=n_workers) as executor:
-                futures = []
-                if nogil:
-                    nogil_fn = method(self, *args, **kwargs)
-                full_kwargs = {**kwargs, **dec_kwargs}
-                for arg in _call_init_fn(init_fn, args, full_kwargs):
-                    margs, mkwargs = _make_args(arg, args, kwargs)
-                    if nogil:
-                        one_ft = executor.submit(nogil_fn, *margs, **mkwargs)
-                    else:
-                        one_ft = executor.submit(method, self, *margs, **mkwargs)
-                    futures.append(one_ft)
-
-                timeout = kwargs.get('timeout', None)
-                cf.wait(futures, timeout=timeout, return_when=cf.ALL_COMPLETED)
-
-            return _call_post_fn(self, post_fn, futures, args, full_kwargs)
-
-        def wrap_with_mpc(self, args, kwargs):
-            """ Run a method in parallel """
-            init_fn, post_fn = _check_functions(self)
-
-            n_workers = kwargs.pop('n_workers', _workers_count())
-            with cf.ProcessPoolExecutor(max_workers=n_workers) as executor:
-                futures = []
-                mpc_func = method(self, *args, **kwargs)
-                full_kwargs = {**kwargs, **dec_kwargs}
-                for arg in _call_init_fn(init_fn, args, full_kwargs):
-                    margs, mkwargs = _make_args(arg, args, kwargs)
-                    one_ft = executor.submit(mpc_func, *margs, **mkwargs)
-                    futures.append(one_ft)
-
-                timeout = kwargs.pop('timeout', None)
-                cf.wait(futures, timeout=timeout, return_when=cf.ALL_COMPLETED)
-
-            return _call_post_fn(self, post_fn, futures, args, full_kwargs)
-
-        def wrap_with_async(self, args, kwargs):
-            """ Run a method in parallel with async / await """
-            try:
-                loop = asyncio.get_event_loop()
-            except RuntimeError:
-                # this is a new thread where there is no loop
-                loop = kwargs.get('loop', None)
-                asyncio.set_event_loop(loop)
-            else:
-                loop = kwargs.get('loop', loop)
+    If results were written into a preallocated array, `output` holds this array
+    and each item in the list is a view of the corresponding slot in it.
+    """
+    def __init__(self, results, output=None):
+        super().__init__(results)
+        self.output = output
 
-            init_fn, post_fn = _check_functions(self)
 
-            futures = []
-            full_kwargs = {**kwargs, **dec_kwargs}
-            for arg in _call_init_fn(init_fn, args, full_kwargs):
-                margs, mkwargs = _make_args(arg, args, kwargs)
-                futures.append(asyncio.ensure_future(method(self, *margs, **mkwargs)))
+class ResultsBuffer:
+    """ A preallocated array which parallelized invocations write their results into
+
+    Args:
+        size: int - the number of invocations
+        shape: tuple - a shape of one result (inferred from the first result if None)
+        dtype: a dtype of results (inferred from the first result if None)
+
+    Results which are not numpy arrays or do not fit into the slot shape are not written,
+    then `output` is None and the post function gets the results as is.
+    """
+    def __init__(self, size, shape=None, dtype=None):
+        self.size = size
+        self.dtype = dtype
+        self.data = None
+        self.disabled = False
+        self._lock = threading.Lock()
+        if shape is not None:
+            self._allocate(tuple(shape), dtype)
+
+    def _allocate(self, shape, dtype):
+        self.data = np.empty((self.size,) + shape, dtype=dtype)
+
+    def put(self, pos, result):
+        """ Write a result into its slot and return a view of the slot """
+        if self.disabled or not isinstance(result, np.ndarray):
+            self.disabled = True
+            return result
+        if self.data is None:
+            with self._lock:
+                if self.data is None:
+                    self._allocate(result.shape, self.dtype or result.dtype)
+        if result.shape != self.data.shape[1:]:
+            self.disabled = True
+            return result
+        self.data[pos] = result
+        return self.data[pos]
+
+    def put_many(self, positions, results):
+        """ Write results for a few items at once and return views of their slots """
+        if self.disabled or not isinstance(results, np.ndarray) or len(results) != len(positions):
+            self.disabled = True
+            return [results[i] for i in range(len(positions))]
+        if self.data is None:
+            with self._lock:
+                if self.data is None:
+                    self._allocate(results.shape[1:], self.dtype or results.dtype)
+        if results.shape[1:] != self.data.shape[1:]:
+            self.disabled = True
+            return list(results)
+        # chunks are contiguous, so a slice is enough
+        slots = slice(positions[0], positions[-1] + 1)
+        self.data[slots] = results
+        return list(self.data[slots])
+
+    @property
+    def output(self):
+        """ The preallocated array if all results have been written into it """
+        return None if self.disabled else self.data
+
+
+def make_chunks(n_items, n_workers, schedule='static'):
+    """ Split item positions into chunks
+
+    Args:
+        n_items: int - the number of items
+        n_workers: int - the number of workers
+        schedule: str - 'static' for one equal chunk per worker,
+                  'guided' for chunks which become smaller towards the end (the remaining number of items
+                  divided by the number of workers), so that workers finish at about the same time
+
+    Return:
+        a list of lists of item positions
+    """
+    if schedule == 'static':
+        return [chunk.tolist() for chunk in np.array_split(np.arange(n_items), max(min(n_workers, n_items), 1))
+                if len(chunk) > 0]
+    if schedule == 'guided':
+        chunks, start = [], 0
+        while start < n_items:
+            size = -(-(n_items - start) // n_workers)
+            chunks.append(list(range(start, start + size)))
+            start += size
+        return chunks
+    raise ValueError("schedule should be one of 'static', 'guided'")
+
+
+def _run_chunk(calls, buffer=None):
+    """ Make calls for a chunk of items
+    Args:
+        calls: list of tuples - a position, a function, args and kwargs for each item
+        buffer: ResultsBuffer or None
+    Return:
+        a list with a result or an exception for each item
+    """
+    results = []
+    for pos, func, args, kwargs in calls:
+        try:
+            result = func(*args, **kwargs)
+            results.append(result if buffer is None else buffer.put(pos, result))
+        except Exception as exc:   # pylint: disable=broad-except
+            results.append(exc)
+    return results
+
+
+def _unchunk(futures, chunks, n_items):
+    """ Return a list of results (or exceptions) for each item from futures for chunks """
+    all_results = [None] * n_items
+    for one_ft, chunk in zip(futures, chunks):
+        try:
+            results = one_ft.result(timeout=0)
+        except Exception as exce:  # pylint: disable=broad-except
+            results = [exce] * len(chunk)
+        for pos, result in zip(chunk, results):
+            all_results[pos] = result
+    return all_results
+
+
+def _call_init_fn(init_fn, args, kwargs):
+    return init_fn(*args, **kwargs) if callable(init_fn) else init_fn
+
+
+def _make_args(init_args, args, kwargs):
+    """ Make args, kwargs tuple """
+    if isinstance(init_args, tuple) and len(init_args) == 2:
+        margs, mkwargs = init_args
+    elif isinstance(init_args, dict):
+        margs = list()
+        mkwargs = init_args
+    else:
+        margs = init_args
+        mkwargs = dict()
+    margs = margs if isinstance(margs, (list, tuple)) else [margs]
+    if len(args) > 0:
+        margs = list(margs) + list(args)
+    if len(kwargs) > 0:
+        mkwargs.update(kwargs)
+    return margs, mkwargs
+
+
+def _call_into_buffer(buffer, pos, func, *args, **kwargs):
+    result = func(*args, **kwargs)
+    return result if buffer is None else buffer.put(pos, result)
+
+
+def _put_future_into_buffer(buffer, pos, future):
+    if not isinstance(future, cf.Future):
+        # a result of an item from a chunk
+        return future if isinstance(future, Exception) else buffer.put(pos, future)
+    if future.done() and future.exception() is None:
+        return buffer.put(pos, future.result())
+    return future
 
-            loop.run_until_complete(asyncio.gather(*futures, loop=loop, return_exceptions=True))
 
-            return _call_post_fn(self, post_fn, futures, args, full_kwargs)
+async def _await_into_buffer(buffer, pos, coro):
+    result = await coro
+    return result if buffer is None else buffer.put(pos, result)
+
+
+@contextlib.contextmanager
+def _budget_slots(n_slots):
+    """ Return concurrency budget slots when workers finish """
+    try:
+        yield
+    finally:
+        if n_slots > 0:
+            get_concurrency_budget().release(n_slots)
+
+
+def _share_batch_data(batch, shared):
+    """ Put batch components into shared memory and return their specs """
+    inputs = []
+    for comp in batch.components or (None,):
+        data = batch.get(component=comp)
+        if is_shareable(data):
+            shared.append(SharedArray(data.shape, data.dtype, data))
+            inputs.append(('shm', shared[-1].spec))
+        else:
+            # other data are sent with each chunk of items
+            inputs.append(('data', data))
+    return inputs
+
+
+def _submit_chunks(executor, job, chunks, item_args, n_running):
+    """ Submit chunks of items so that no more than `n_running` chunks are processed at once """
+    futures, running = [], set()
+    for chunk in chunks:
+        if len(running) >= n_running:
+            _, running = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+        one_ft = executor.submit(run_chunk, job, chunk, [item_args[pos] for pos in chunk])
+        futures.append(one_ft)
+        running.add(one_ft)
+    return futures
+
+
+class _ParallelMethod:
+    """ Run a method decorated with `inbatch_parallel` with a given parallelization engine
+
+    Args:
+        method: callable - a decorated method
+        init, post, target, preallocate, schedule: see `inbatch_parallel`
+        dec_kwargs: dict - other decorator arguments which are passed to init and post functions
+    """
+    def __init__(self, method, *, init, post=None, target='threads', preallocate=None, schedule=None,
+                 dec_kwargs=None):
+        self.method = method
+        self.init = init
+        self.post = post
+        self.target = target
+        self.preallocate = preallocate
+        self.schedule = schedule
+        self.dec_kwargs = dec_kwargs or dict()
+        self.worker_tuner = WorkerTuner()
+
+    def __call__(self, batch, args, kwargs):
+        """ Run a method in a required parallel engine """
+        if asyncio.iscoroutinefunction(self.method) or self.target == 'async':
+            return self.wrap_with_async(batch, args, kwargs)
+        wrappers = {'threads': self.wrap_with_threads, 't': self.wrap_with_threads,
+                    'nogil': functools.partial(self.wrap_with_threads, nogil=True),
+                    'mpc': self.wrap_with_mpc, 'm': self.wrap_with_mpc,
+                    'shm': self.wrap_with_shm, 'batch': self.wrap_with_batch,
+                    'for': self.wrap_with_for, 'f': self.wrap_with_for}
+        if self.target not in wrappers:
+            raise ValueError('Wrong parallelization target:', self.target)
+        return wrappers[self.target](batch, args, kwargs)
+
+    def _check_functions(self, batch):
+        """ Check dcorator's `init` and `post` parameters """
+        if self.init is None:
+            raise ValueError("init cannot be None")
+        try:
+            init_fn = getattr(batch, self.init)
+        except AttributeError:
+            raise ValueError("init should refer to a method or property of the class", type(batch).__name__,
+                             "returning the list of arguments")
+        if self.post is not None:
+            try:
+                post_fn = getattr(batch, self.post)
+            except AttributeError:
+                raise ValueError("post should refer to a method of the class", type(batch).__name__)
+            if not callable(post_fn):
+                raise ValueError("post should refer to a method of the class", type(batch).__name__)
+        else:
+            post_fn = None
+        return init_fn, post_fn
+
+    def _make_buffer(self, all_args):
+        """ Create a buffer for results if it is required """
+        if not self.preallocate:
+            return None
+        buffer_params = self.preallocate if isinstance(self.preallocate, dict) else dict()
+        return ResultsBuffer(len(all_args), **buffer_params)
 
-        def wrap_with_for(self, args, kwargs):
-            """ Run a method in parallel """
-            init_fn, post_fn = _check_functions(self)
+    def _call_post_fn(self, batch, post_fn, futures, *, args, kwargs, buffer=None):
+        all_results = []
+        for future in futures:
+            try:
+                if isinstance(future, (cf.Future, asyncio.Task)):
+                    result = future.result()
+                else:
+                    result = future
+            except Exception as exce:  # pylint: disable=broad-except
+                result = exce
+            finally:
+                all_results += [result]
+
+        output = buffer.output if buffer is not None and not any_action_failed(all_results) else None
+        all_results = ParallelResults(all_results, output)
+
+        if post_fn is None:
+            if any_action_failed(all_results):
+                all_errors = [error for error in all_results if isinstance(error, Exception)]
+                print(all_errors)
+                traceback.print_tb(all_errors[0].__traceback__)
+            return batch
+        return post_fn(all_results, *args, **kwargs)
+
+    def _get_n_workers(self, kwargs, default=None):
+        """ Return the number of workers, how many of them might run at once, whether the number is tuned
+        and how many concurrency budget slots are taken """
+        n_workers = kwargs.pop('n_workers', default or _workers_count())
+        auto_workers = n_workers == 'auto'
+        if auto_workers:
+            n_workers = self.worker_tuner.get()
+        budget = get_concurrency_budget()
+        if budget is None:
+            return n_workers, n_workers, auto_workers, 0
+        # the current thread waits for workers, so one of them runs instead of it
+        n_slots = budget.try_acquire(n_workers - 1)
+        # throughput with fewer workers than requested would mislead the tuner
+        return n_workers, n_slots + 1, auto_workers and n_slots + 1 == n_workers, n_slots
+
+    def wrap_with_threads(self, batch, args, kwargs, nogil=False):
+        """ Run a method in parallel """
+        init_fn, post_fn = self._check_functions(batch)
+
+        _, n_workers, auto_workers, n_slots = self._get_n_workers(kwargs)
+        start_time = time.perf_counter()
+        with _budget_slots(n_slots), cf.ThreadPoolExecutor(max_workers=n_workers) as executor:
+            if nogil:
+                nogil_fn = self.method(batch, *args, **kwargs)
+            full_kwargs = {**kwargs, **self.dec_kwargs}
+            all_args = list(_call_init_fn(init_fn, args, full_kwargs))
+            buffer = self._make_buffer(all_args)
+            calls = []
+            for pos, arg in enumerate(all_args):
+                margs, mkwargs = _make_args(arg, args, kwargs)
+                if nogil:
+                    calls.append((pos, nogil_fn, margs, mkwargs))
+                else:
+                    calls.append((pos, self.method, [batch] + list(margs), mkwargs))
 
-            _ = kwargs.pop('n_workers', _workers_count())
-            futures = []
-            full_kwargs = {**kwargs, **dec_kwargs}
-            for arg in _call_init_fn(init_fn, args, full_kwargs):
+            if self.schedule is None:
+                futures = [executor.submit(_call_into_buffer, buffer, pos, func, *margs, **mkwargs)
+                           for pos, func, margs, mkwargs in calls]
+            else:
+                chunks = make_chunks(len(calls), n_workers, self.schedule)
+                futures = [executor.submit(_run_chunk, [calls[pos] for pos in chunk], buffer) for chunk in chunks]
+
+            timeout = kwargs.get('timeout', None)
+            cf.wait(futures, timeout=timeout, return_when=cf.ALL_COMPLETED)
+            if self.schedule is not None:
+                futures = _unchunk(futures, chunks, len(calls))
+
+        if auto_workers:
+            self.worker_tuner.update(n_workers, len(all_args), time.perf_counter() - start_time)
+        return self._call_post_fn(batch, post_fn, futures, args=args, kwargs=full_kwargs, buffer=buffer)
+
+    def wrap_with_mpc(self, batch, args, kwargs):
+        """ Run a method in parallel """
+        init_fn, post_fn = self._check_functions(batch)
+
+        _, n_workers, auto_workers, n_slots = self._get_n_workers(kwargs)
+        start_time = time.perf_counter()
+        with _budget_slots(n_slots), cf.ProcessPoolExecutor(max_workers=n_workers) as executor:
+            mpc_func = self.method(batch, *args, **kwargs)
+            full_kwargs = {**kwargs, **self.dec_kwargs}
+            all_args = list(_call_init_fn(init_fn, args, full_kwargs))
+            buffer = self._make_buffer(all_args)
+            calls = []
+            for pos, arg in enumerate(all_args):
                 margs, mkwargs = _make_args(arg, args, kwargs)
-                try:
-                    one_ft = method(self, *margs, **mkwargs)
-                    if callable(one_ft):
-                        one_ft = one_ft(*margs, **mkwargs)
-                except Exception as e:   # pylint: disable=broad-except
-                    one_ft = e
-                futures.append(one_ft)
+                calls.append((pos, mpc_func, margs, mkwargs))
+
+            if self.schedule is None:
+                futures = [executor.submit(mpc_func, *margs, **mkwargs) for _, _, margs, mkwargs in calls]
+            else:
+                chunks = make_chunks(len(calls), n_workers, self.schedule)
+                futures = [executor.submit(_run_chunk, [calls[pos] for pos in chunk]) for chunk in chunks]
+
+            timeout = kwargs.pop('timeout', None)
+            cf.wait(futures, timeout=timeout, return_when=cf.ALL_COMPLETED)
+            if self.schedule is not None:
+                futures = _unchunk(futures, chunks, len(calls))
+            if buffer is not None:
+                # results come from other processes, so they can be written into the buffer only here
+                futures = [_put_future_into_buffer(buffer, pos, one_ft) for pos, one_ft in enumerate(futures)]
+
+        if auto_workers:
+            self.worker_tuner.update(n_workers, len(all_args), time.perf_counter() - start_time)
+        return self._call_post_fn(batch, post_fn, futures, args=args, kwargs=full_kwargs, buffer=buffer)
+
+    def wrap_with_shm(self, batch, args, kwargs):
+        """ Run a method in worker processes which read batch data from shared memory """
+        init_fn, post_fn = self._check_functions(batch)
+
+        n_workers, n_running, auto_workers, n_slots = self._get_n_workers(kwargs, cpu_count())
+        start_time = time.perf_counter()
+        shared = []
+        with _budget_slots(n_slots):
+            try:
+                shm_func = self.method(batch, *args, **kwargs)
+                full_kwargs = {**kwargs, **self.dec_kwargs}
+                all_args = list(_call_init_fn(init_fn, args, full_kwargs))
+                if len(all_args) != len(batch):
+                    raise ValueError("init should return one argument for each batch item with target='shm'")
+                buffer = self._make_buffer(all_args)
+                job = dict(func=shm_func, inputs=_share_batch_data(batch, shared), output=None,
+                           single=batch.components is None)
+                if buffer is not None and buffer.data is not None:
+                    shared.append(SharedArray(buffer.data.shape, buffer.data.dtype))
+                    job['output'] = shared[-1].spec
+
+                item_args = [_make_args(arg, args, kwargs) for arg in all_args]
+                if self.schedule is None:
+                    chunks = make_chunks(len(all_args), n_workers * 4, 'static')
+                else:
+                    chunks = make_chunks(len(all_args), n_workers, self.schedule)
+                futures = _submit_chunks(get_shm_executor(n_workers), job, chunks, item_args, n_running)
+                cf.wait(futures, timeout=kwargs.pop('timeout', None), return_when=cf.ALL_COMPLETED)
+
+                all_results = _unchunk(futures, chunks, len(all_args))
+                if job['output'] is not None:
+                    buffer.data[...] = shared[-1].array
+                    all_results = [buffer.data[pos] if res is None else res for pos, res in enumerate(all_results)]
+                elif buffer is not None:
+                    all_results = [_put_future_into_buffer(buffer, pos, res) for pos, res in enumerate(all_results)]
+            finally:
+                for shared_array in shared:
+                    shared_array.close()
+
+        if auto_workers:
+            self.worker_tuner.update(n_workers, len(all_args), time.perf_counter() - start_time)
+        return self._call_post_fn(batch, post_fn, all_results, args=args, kwargs=full_kwargs, buffer=buffer)
+
+    def _call_vectorized(self, batch, items, args, kwargs, *, buffer=None, positions=None):
+        """ Call a method once for a few items with their arguments stacked into arrays
+        Return:
+            a list with a result (or an exception) for each item
+        """
+        try:
+            margs = [np.asarray([item_args[i] for item_args, _ in items]) for i in range(len(items[0][0]))]
+            mkwargs = {key: np.asarray([item_kwargs[key] for _, item_kwargs in items]) for key in items[0][1]}
+            results = self.method(batch, *margs, *args, **{**mkwargs, **kwargs})
+            if results is None:
+                return [None] * len(items)
+            if len(results) != len(items):
+                raise ValueError("A vectorized method should return one result for each item, but returned %d "
+                                 "results for %d items" % (len(results), len(items)))
+            if buffer is not None:
+                return buffer.put_many(positions, results)
+            return [results[i] for i in range(len(items))]
+        except Exception as exce:  # pylint: disable=broad-except
+            return [exce] * len(items)
+
+    def wrap_with_batch(self, batch, args, kwargs):
+        """ Call a method with arguments of all items (or chunks of items in parallel threads) """
+        init_fn, post_fn = self._check_functions(batch)
+
+        _, n_workers, _, n_slots = self._get_n_workers(kwargs, cpu_count())
+        full_kwargs = {**kwargs, **self.dec_kwargs}
+        all_args = list(_call_init_fn(init_fn, args, full_kwargs))
+        buffer = self._make_buffer(all_args)
+        # only arguments from init are stacked, while action arguments are passed as is
+        items = [_make_args(arg, (), {}) for arg in all_args]
+        with _budget_slots(n_slots):
+            chunks = make_chunks(len(items), n_workers, self.schedule or 'static')
+            if len(chunks) <= 1:
+                all_results = self._call_vectorized(batch, items, args, kwargs, buffer=buffer,
+                                                    positions=list(range(len(items))))
+            else:
+                with cf.ThreadPoolExecutor(max_workers=n_workers) as executor:
+                    futures = [executor.submit(self._call_vectorized, batch, [items[pos] for pos in chunk], args,
+                                               kwargs, buffer=buffer, positions=chunk) for chunk in chunks]
+                    cf.wait(futures, timeout=kwargs.get('timeout', None), return_when=cf.ALL_COMPLETED)
+                all_results = _unchunk(futures, chunks, len(items))
+
+        return self._call_post_fn(batch, post_fn, all_results, args=args, kwargs=full_kwargs, buffer=buffer)
+
+    def wrap_with_async(self, batch, args, kwargs):
+        """ Run a method in parallel with async / await """
+        try:
+            loop = asyncio.get_event_loop()
+        except RuntimeError:
+            # this is a new thread where there is no loop
+            loop = kwargs.get('loop', None)
+            asyncio.set_event_loop(loop)
+        else:
+            loop = kwargs.get('loop', loop)
+
+        init_fn, post_fn = self._check_functions(batch)
+
+        futures = []
+        full_kwargs = {**kwargs, **self.dec_kwargs}
+        all_args = list(_call_init_fn(init_fn, args, full_kwargs))
+        buffer = self._make_buffer(all_args)
+        for pos, arg in enumerate(all_args):
+            margs, mkwargs = _make_args(arg, args, kwargs)
+            coro = self.method(batch, *margs, **mkwargs)
+            futures.append(asyncio.ensure_future(_await_into_buffer(buffer, pos, coro)))
+
+        loop.run_until_complete(asyncio.gather(*futures, loop=loop, return_exceptions=True))
+
+        return self._call_post_fn(batch, post_fn, futures, args=args, kwargs=full_kwargs, buffer=buffer)
+
+    def wrap_with_for(self, batch, args, kwargs):
+        """ Run a method in parallel """
+        init_fn, post_fn = self._check_functions(batch)
+
+        _ = kwargs.pop('n_workers', _workers_count())
+        futures = []
+        full_kwargs = {**kwargs, **self.dec_kwargs}
+        all_args = list(_call_init_fn(init_fn, args, full_kwargs))
+        buffer = self._make_buffer(all_args)
+        for pos, arg in enumerate(all_args):
+            margs, mkwargs = _make_args(arg, args, kwargs)
+            try:
+                one_ft = self.method(batch, *margs, **mkwargs)
+                if callable(one_ft):
+                    one_ft = one_ft(*margs, **mkwargs)
+                if buffer is not None:
+                    one_ft = buffer.put(pos, one_ft)
+            except Exception as e:   # pylint: disable=broad-except
+                one_ft = e
+            futures.append(one_ft)
+
+        return self._call_post_fn(batch, post_fn, futures, args=args, kwargs=full_kwargs, buffer=buffer)
+
+
+def inbatch_parallel(init, post=None, target='threads', preallocate=None, schedule=None, **dec_kwargs):
+    """ Make in-batch parallel decorator
+
+    Args:
+        init: str - a method name which returns arguments for each parallel invocation
+        post: str - a method name which is called with the list of all results
+        target: str - a parallelization engine
+        preallocate: bool or dict - whether to write array results straight into one preallocated array
+                     which is available to the post function as `all_res.output`.
+                     A dict might declare `shape` (of one result) and `dtype` of the array,
+                     otherwise they are inferred from the first result.
+        schedule: str or None - how to group items into tasks for `threads`, `nogil`, `mpc`, `shm` and `batch`:
+                  None - one task per item ('static' with 4 chunks per worker for `shm`, 'static' for `batch`),
+                  'static' - one equal chunk of items per worker,
+                  'guided' - chunks of a decreasing size (see `make_chunks`).
+                  Errors are still reported for each item.
+
+    The number of workers might be passed to a decorated method as `n_workers`.
+    With `n_workers='auto'` it is tuned at runtime for the highest throughput (items per second)
+    and `method.worker_tuner.stats()` shows measured results.
+
+    With `target='shm'` the method should return a picklable function which is called in worker processes
+    as `func(item, *item_args, **item_kwargs)` where `item` holds data of one batch item (a tuple over components).
+    Array components are put into shared memory once per call, so workers get only item positions,
+    and with `preallocate=dict(shape=..., dtype=...)` results are written into a shared output array.
+    Worker processes are kept between calls.
+
+    With `target='batch'` the method is called once for a chunk of items (one chunk per worker thread,
+    or one call for all items with `n_workers=1`), while arguments from init are stacked into arrays,
+    e.g. it gets an array of indices instead of one index. It should return one result per item (or None).
+    An error fails all items in the chunk.
+    """
+    if target not in ['nogil', 'threads', 'mpc', 'shm', 'batch', 'async', 'for', 't', 'm', 'a', 'f']:
+        raise ValueError("target should be one of 'threads', 'mpc', 'shm', 'batch', 'async', 'for'")
+    if schedule not in [None, 'static', 'guided']:
+        raise ValueError("schedule should be one of None, 'static', 'guided'")
 
-            return _call_post_fn(self, post_fn, futures, args, full_kwargs)
+    def inbatch_parallel_decorator(method):
+        """ Return a decorator which run a method in parallel """
+        runner = _ParallelMethod(method, init=init, post=post, target=target, preallocate=preallocate,
+                                 schedule=schedule, dec_kwargs=dec_kwargs)
 
         @functools.wraps(method)
         def wrapped_method(self, *args, **kwargs):
             """ Wrap a method in a required parallel engine """
-            if asyncio.iscoroutinefunction(method) or target == 'async':
-                return wrap_with_async(self, args, kwargs)
-            if target in ['threads', 't']:
-                return wrap_with_threads(self, args, kwargs)
-            elif target == 'nogil':
-                return wrap_with_threads(self, args, kwargs, nogil=True)
-            elif target in ['mpc', 'm']:
-                return wrap_with_mpc(self, args, kwargs)
-            elif target in ['for', 'f']:
-                return wrap_with_for(self, args, kwargs)
-            raise ValueError('Wrong parallelization target:', target)
+            return runner(self, args, kwargs)
+        wrapped_method.worker_tuner = runner.worker_tuner
         return wrapped_method
     return inbatch_parallel_decorator
 
@@ -2,12 +2,38 @@
 
 import os
 import glob
+import hashlib
+import threading
+import weakref
+import concurrent.futures as cf
 from collections import Iterable
 import numpy as np
 
 from .base import Baseset
 
 
+_ORDER_EXECUTOR = None
+_ORDER_EXECUTOR_LOCK = threading.Lock()
+
+
+def _get_order_executor():
+    """ Return a thread pool which generates orders for the next epochs """
+    global _ORDER_EXECUTOR     # pylint: disable=global-statement
+    if _ORDER_EXECUTOR is None:
+        with _ORDER_EXECUTOR_LOCK:
+            if _ORDER_EXECUTOR is None:
+                _ORDER_EXECUTOR = cf.ThreadPoolExecutor()
+    return _ORDER_EXECUTOR
+
+
+def _resolve_order_ahead(iter_params):
+    """ Wait for the order of the next epoch if it is still being generated """
+    ahead = iter_params.get('_order_ahead')
+    if isinstance(ahead, cf.Future):
+        iter_params['_order_ahead'] = ahead.result()
+    return iter_params
+
+
 class DatasetIndex(Baseset):
     """ Stores an index for a dataset
     The index should be 1-d array-like, e.g. numpy array, pandas Series, etc.
@@ -16,6 +42,54 @@ class DatasetIndex(Baseset):
         super().__init__(*args, **kwargs)
         self._pos = self.build_pos()
         self._random_state = None
+        self._fingerprint = None
+        # a weak reference to the index this one is a contiguous part of, and positions of this part in it
+        self._parent = None
+        self._parent_range = None
+
+    @property
+    def provenance(self):
+        """ A tuple of an index and positions in it which this index takes (the index itself if it is not a part) """
+        parent = self._parent() if self._parent is not None else None
+        if parent is None:
+            return self, 0, len(self)
+        return (parent,) + self._parent_range
+
+    def is_same(self, other):
+        """ Check if indices have the same items in the same order
+        Lengths and dtypes are compared first, then where indices come from, and fingerprints only after that.
+        """
+        if self is other:
+            return True
+        if len(self) != len(other) or np.asarray(self.indices).dtype != np.asarray(other.indices).dtype:
+            return False
+        provenance, other_provenance = self.provenance, other.provenance
+        if provenance[0] is other_provenance[0] and provenance[1:] == other_provenance[1:]:
+            return True
+        return self.fingerprint == other.fingerprint
+
+    @property
+    def fingerprint(self):
+        """ A tuple which identifies index values: the length, dtype and a hash of values
+        It is calculated once, so indices should not be changed in place.
+        """
+        if self._fingerprint is None:
+            indices = np.asarray(self.indices)
+            if indices.dtype.hasobject:
+                data = repr(indices.tolist()).encode()
+            else:
+                data = np.ascontiguousarray(indices).tobytes()
+            self._fingerprint = len(indices), indices.dtype.str, hashlib.sha1(data).hexdigest()
+        return self._fingerprint
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # a weak reference cannot be pickled
+        state['_parent'], state['_parent_range'] = None, None
+        if self._iter_params is not None:
+            # a future with the next order cannot be pickled
+            state['_iter_params'] = _resolve_order_ahead(dict(self._iter_params))
+        return state
 
     @classmethod
     def from_index(cls, *args, **kwargs):
@@ -77,6 +151,14 @@ class DatasetIndex(Baseset):
         """ Return a new index object based on the subset of indices given """
         return type(self)(index)
 
+    def _create_subset_by_range(self, start, stop):
+        """ Return a subset of items from start to stop positions which remembers where it comes from """
+        subset = self.create_subset(self.subset_by_pos(np.arange(start, stop)))
+        parent, parent_start, _ = self.provenance
+        subset._parent = weakref.ref(parent)    # pylint: disable=protected-access
+        subset._parent_range = int(parent_start + start), int(parent_start + stop)   # pylint: disable=protected-access
+        return subset
+
     def cv_split(self, shares=0.8, shuffle=False):
         """ Split index into train, test and validation subsets
         Shuffles index if necessary.
@@ -96,23 +178,27 @@ class DatasetIndex(Baseset):
         if shuffle:
             order = self._shuffle(shuffle)
         else:
-            order = np.arange(len(self))
+            order = None
+
+        def _subset(start, stop):
+            if order is None:
+                return self._create_subset_by_range(start, stop)
+            return self.create_subset(self.subset_by_pos(order[start:stop]))
 
         if valid_share > 0:
-            validation_pos = order[:valid_share]
-            self.validation = self.create_subset(self.subset_by_pos(validation_pos))
+            self.validation = _subset(0, valid_share)
         if test_share > 0:
-            test_pos = order[valid_share : valid_share + test_share]
-            self.test = self.create_subset(self.subset_by_pos(test_pos))
-        train_pos = order[valid_share + test_share:]
-        self.train = self.create_subset(self.subset_by_pos(train_pos))
+            self.test = _subset(valid_share, valid_share + test_share)
+        self.train = _subset(valid_share + test_share, len(self))
 
 
-    def _shuffle(self, shuffle, iter_params=None):
+    def _shuffle(self, shuffle, iter_params=None, order=None):
         if iter_params is None:
             iter_params = self._iter_params
 
-        if iter_params['_order'] is None:
+        if order is not None:
+            pass
+        elif iter_params['_order'] is None:
             order = np.arange(len(self))
         else:
             order = iter_params['_order']
@@ -134,8 +220,105 @@ class DatasetIndex(Baseset):
             raise ValueError("shuffle could be bool, int, numpy.random.RandomState or callable")
         return order
 
+    def get_state(self, iter_params=None):
+        """ Return iteration state: the current order, position, the number of epochs and random state
+        Arrays are not copied as iteration replaces them rather than changes them in place.
+        `iter_params` might also be a shallow copy of iteration params taken earlier.
+
+        It does not wait for the order of the next epoch which is generated in the background.
+        Instead, the state keeps random state and the full order taken before it started,
+        so that the same order is generated again after the state is restored.
+        """
+        if iter_params is None:
+            iter_params = self._iter_params
+        state = dict(iter_params)
+        ahead_state = state['_ahead_state']
+        state['_ahead_state'] = None
+        if ahead_state is not None:
+            state['_order_ahead'] = None
+            state.update(ahead_state)
+        elif state['_random_state'] is not None:
+            state['_random_state'] = state['_random_state'].get_state()
+        return state
+
+    def set_state(self, state, iter_params=None):
+        """ Restore iteration state saved with `get_state`
+        Return:
+            iter_params with the restored state
+        """
+        if iter_params is None:
+            iter_params = self._iter_params
+        iter_params.update(state)
+        if state['_random_state'] is not None:
+            iter_params['_random_state'] = np.random.RandomState()
+            iter_params['_random_state'].set_state(state['_random_state'])
+        return iter_params
+
+    @staticmethod
+    def shard_order(order, shard_id, num_shards, drop_last=False):
+        """ Return a part of the order for a given shard
+        Items are dealt to shards in turn, so that all shards get the same number of items:
+        if drop_last is True, the last `len(order) % num_shards` items are dropped,
+        otherwise the order is padded with items from its beginning.
+        """
+        if not 0 <= shard_id < num_shards:
+            raise ValueError("shard_id should be in range [0, num_shards)")
+        shard_size = len(order) // num_shards if drop_last else -(-len(order) // num_shards)
+        if shard_size == 0:
+            raise ValueError("The index has fewer items than shards")
+        order = np.resize(order, shard_size * num_shards)
+        return order[shard_id::num_shards]
+
+    def _next_order(self, shuffle, iter_params, *, drop_last=False, shard_id=None, num_shards=None, order=None):
+        """ Return the order of items for the next epoch (only items of the shard when iteration is sharded) """
+        if num_shards is None:
+            return self._shuffle(shuffle, iter_params, order)
+        # all shards shuffle the full order in the same way and then take their own part of it
+        full_order = iter_params.get('_full_order')
+        if full_order is None:
+            full_order = np.arange(len(self))
+        iter_params['_full_order'] = self._shuffle(shuffle, iter_params, full_order)
+        return self.shard_order(iter_params['_full_order'], shard_id, num_shards, drop_last)
+
+    def _take_order(self, shuffle, iter_params, drop_last=False, shard_id=None, num_shards=None):
+        """ Return the order for the next epoch and start generating the order for the epoch after it
+        Shuffling a large index takes a while, so the next order is generated in a background thread
+        while batches of the current epoch are being taken.
+        """
+        if shuffle is True and num_shards is not None and num_shards > 1:
+            raise ValueError("Sharded iteration requires shuffle to be False, a seed or a callable,"
+                             " so that all shards get the same order")
+        _resolve_order_ahead(iter_params)
+        order = iter_params['_order_ahead']
+        if order is None:
+            order = self._next_order(self._seed_shuffle(shuffle, iter_params), iter_params, drop_last=drop_last,
+                                     shard_id=shard_id, num_shards=num_shards, order=iter_params['_order'])
+        iter_params['_order_ahead'] = None
+        iter_params['_ahead_state'] = None
+        iter_params['_seed'] = None
+        if shuffle is not False:
+            shuffle = self._seed_shuffle(shuffle, iter_params)
+            random_state = iter_params['_random_state']
+            iter_params['_ahead_state'] = dict(_seed=iter_params['_seed'], _full_order=iter_params['_full_order'],
+                                               _random_state=None if random_state is None else random_state.get_state())
+            iter_params['_order_ahead'] = _get_order_executor().submit(self._next_order, shuffle, iter_params,
+                                                                        drop_last=drop_last, shard_id=shard_id,
+                                                                        num_shards=num_shards, order=order)
+        return order
 
-    def next_batch(self, batch_size, shuffle=False, n_epochs=1, drop_last=False, iter_params=None):
+    @staticmethod
+    def _seed_shuffle(shuffle, iter_params):
+        """ Replace shuffle=True with a random state seeded from `np.random` in the calling thread
+        The seed is kept in iter_params until the order is taken, so that the order can be generated again.
+        """
+        if shuffle is not True:
+            return shuffle
+        if iter_params['_seed'] is None:
+            iter_params['_seed'] = np.random.randint(2**31)
+        return np.random.RandomState(iter_params['_seed'])
+
+    def next_batch(self, batch_size, shuffle=False, n_epochs=1, drop_last=False, iter_params=None, *args,  # pylint: disable=keyword-arg-before-vararg
+                   shard_id=None, num_shards=None, **kwargs):
         """ Return next batch
         Args:
             batch_size: int - desired number of items in the batch (the actual batch could contain fewer items)
@@ -163,6 +346,15 @@ class DatasetIndex(Baseset):
             one of the identical items will be missed.
             However, there is nothing to worry about if you don't iterate over batch items explicitly
             (i.e. for item in batch) or implicitly (through batch[ix]).
+
+            shard_id: int - the number of the shard to iterate over (from 0 to num_shards - 1)
+
+            num_shards: int - the number of shards, e.g. data-parallel workers.
+            Each epoch the whole index is shuffled in the same way in every shard (so shuffle should be
+            a seed, not True) and then split into num_shards disjoint parts of the same size,
+            so all shards produce the same number of batches.
+
+            args, kwargs are passed to `create_batch`.
         """
         if iter_params is None:
             iter_params = self._iter_params
@@ -171,12 +363,12 @@ class DatasetIndex(Baseset):
             raise StopIteration("Dataset is over. No more batches left.")
 
         if iter_params['_order'] is None:
-            iter_params['_order'] = self._shuffle(shuffle, iter_params)
+            iter_params['_order'] = self._take_order(shuffle, iter_params, drop_last, shard_id, num_shards)
         num_items = len(iter_params['_order'])
 
         rest_items = None
         if iter_params['_start_index'] + batch_size >= num_items:
-            rest_items = np.copy(iter_params['_order'][iter_params['_start_index']:])
+            rest_items = iter_params['_order'][iter_params['_start_index']:]
             rest_of_batch = iter_params['_start_index'] + batch_size - num_items
             if rest_of_batch > 0:
                 if drop_last:
@@ -184,7 +376,7 @@ class DatasetIndex(Baseset):
                     rest_of_batch = batch_size
             iter_params['_start_index'] = 0
             iter_params['_n_epochs'] += 1
-            iter_params['_order'] = self._shuffle(shuffle, iter_params)
+            iter_params['_order'] = self._take_order(shuffle, iter_params, drop_last, shard_id, num_shards)
         else:
             rest_of_batch = batch_size
 
@@ -200,20 +392,30 @@ class DatasetIndex(Baseset):
                 raise StopIteration("Dataset is over. No more batches left.")
             else:
                 iter_params['_stop_iter'] = True
-                return self.create_batch(rest_items, pos=True)
+                return self.create_batch(rest_items, True, *args, **kwargs)
         else:
             iter_params['_start_index'] += rest_of_batch
-            return self.create_batch(batch_items, pos=True)
+            return self.create_batch(batch_items, True, *args, **kwargs)
 
 
-    def gen_batch(self, batch_size, shuffle=False, n_epochs=1, drop_last=False):
-        """ Generate batches """
-        iter_params = self.get_default_iter_params()
+    def gen_batch(self, batch_size, shuffle=False, n_epochs=1, drop_last=False, *args,   # pylint: disable=keyword-arg-before-vararg
+                  shard_id=None, num_shards=None, iter_params=None, **kwargs):
+        """ Generate batches
+        iter_params might be given to continue iteration from a saved state (see `get_state`),
+        args, kwargs are passed to `create_batch`.
+        """
+        if iter_params is None:
+            iter_params = self.get_default_iter_params()
         while True:
             if n_epochs is not None and iter_params['_n_epochs'] >= n_epochs:
-                raise StopIteration()
+                return
             else:
-                batch = self.next_batch(batch_size, shuffle, n_epochs, drop_last, iter_params)
+                try:
+                    batch = self.next_batch(batch_size, shuffle, n_epochs, drop_last, iter_params, *args,
+                                            shard_id=shard_id, num_shards=num_shards, **kwargs)
+                except StopIteration:
+                    # a generator should not raise StopIteration (PEP 479)
+                    return
                 yield batch
 
 
@@ -1,6 +1,7 @@
 """ Contains Batch classes for images """
 
 import os   # pylint: disable=unused-import
+import numbers
 import traceback
 
 try:
@@ -31,23 +32,49 @@ CROP_00 = -2
 
 
 @njit(nogil=True)
-def random_crop_numba(images, shape):
-    """ Fill-in new_images with random crops from images """
-    new_images = np.zeros((images.shape[0],) + shape, dtype=images.dtype)
-    if images.shape[2] - shape[0] > 0:
-        origin_x = np.random.randint(0, images.shape[2] - shape[0], size=images.shape[0])
-    else:
-        origin_x = np.zeros(images.shape[0], dtype=np.array(images.shape).dtype)
-    if images.shape[1] - shape[1] > 0:
-        origin_y = np.random.randint(0, images.shape[1] - shape[1], size=images.shape[0])
-    else:
-        origin_y = np.zeros(images.shape[0], dtype=np.array(images.shape).dtype)
+def crop_numba(images, origins, shape):
+    """ Crop each image at its own origin (x, y) to the given shape (width, height)
+
+    It releases GIL but runs in a single thread, since numba parallel loops abort the process
+    when they are called from several threads at once with the default threading layer.
+    """
+    new_images = np.empty((images.shape[0], shape[1], shape[0]) + images.shape[3:], dtype=images.dtype)
     for i in range(images.shape[0]):
-        x = slice(origin_x[i], origin_x[i] + shape[0])
-        y = slice(origin_y[i], origin_y[i] + shape[1])
-        new_images[i, :, :] = images[i, y, x]
+        x, y = origins[i, 0], origins[i, 1]
+        new_images[i] = images[i, y:y + shape[1], x:x + shape[0]]
     return new_images
 
+def calc_crop_origins(sizes, origin, shape):
+    """ Return an array of crop origins (x, y) for images of given sizes
+    Args:
+        sizes: array (N, 2) - image sizes in the form of (width, height)
+        origin: can be one of:
+                - tuple - the same starting point (x, y) for all images
+                - array (N, 2) - a starting point for each image
+                - CROP_00 - to crop from left top edge (0,0)
+                - CROP_CENTER - to crop from center of each image
+        shape: tuple - a crop size in the form of (width, height)
+    """
+    if origin is None or isinstance(origin, numbers.Integral) and origin == CROP_00:
+        origins = np.zeros_like(sizes)
+    elif isinstance(origin, numbers.Integral) and origin == CROP_CENTER:
+        origins = np.maximum(sizes - np.asarray(shape), 0) // 2
+    else:
+        origins = np.broadcast_to(np.asarray(origin, dtype=sizes.dtype), sizes.shape)
+    if np.any(origins < 0):
+        raise ValueError("Crop origin cannot be negative", origin)
+    return np.ascontiguousarray(origins)
+
+def random_crop_origins(sizes, shape):
+    """ Return an array of random crop origins (x, y) which fit the shape into images of given sizes """
+    return np.random.randint(0, np.maximum(sizes - np.asarray(shape), 0) + 1, size=sizes.shape)
+
+def fit_crop_shape(sizes, origins, shape):
+    """ Shrink the crop shape (width, height) so that crops do not exceed image bounds """
+    max_shape = (sizes - origins).min(axis=0)
+    shape = max_shape if shape is None else np.minimum(shape, max_shape)
+    return tuple(int(side) for side in shape)
+
 @njit(nogil=True)
 def calc_origin(image_coord, shape_coord, crop):
     """ Return origin for preserve_shape """
@@ -151,7 +178,7 @@ class BasicImagesBatch(Batch):
         return self
 
     @action
-    @inbatch_parallel(init='indices', post='assemble')
+    @inbatch_parallel(init='indices', post='assemble', preallocate=True)
     def resize(self, ix, component='images', shape=(64, 64)):
         """ Resize all images in the batch to the given shape
         Args:
@@ -161,7 +188,7 @@ class BasicImagesBatch(Batch):
         return self._resize_one(ix, component, shape)
 
     @action
-    @inbatch_parallel(init='indices', post='assemble')
+    @inbatch_parallel(init='indices', post='assemble', preallocate=True)
     def random_scale(self, ix, component='images', p=1., factor=None, preserve_shape=True, crop=CROP_CENTER):
         """ Scale the content of each image in the batch with a random scale factor
         Args:
@@ -190,7 +217,7 @@ class BasicImagesBatch(Batch):
         raise NotImplementedError()
 
     @action
-    @inbatch_parallel(init='indices', post='assemble')
+    @inbatch_parallel(init='indices', post='assemble', preallocate=True)
     def rotate(self, ix, component='images', angle=0, preserve_shape=True, **kwargs):
         """ Rotate all images in the batch at the given angle
         Args:
@@ -202,7 +229,7 @@ class BasicImagesBatch(Batch):
         return self._rotate_one(ix, component, angle, preserve_shape, **kwargs)
 
     @action
-    @inbatch_parallel(init='indices', post='assemble')
+    @inbatch_parallel(init='indices', post='assemble', preallocate=True)
     def random_rotate(self, ix, component='images', p=1., angle=None, **kwargs):
         """ Rotate each image in the batch at a random angle
         Args:
@@ -256,6 +283,10 @@ class ImagesBatch(BasicImagesBatch):
             raise RuntimeError("Could not assemble the batch")
 
         component = kwargs.get('component', 'images')
+        if getattr(all_res, 'output', None) is not None:
+            # results have been already written into one array
+            setattr(self, component, all_res.output)
+            return self
         try:
             new_images = np.stack(all_res)
         except ValueError as e:
@@ -269,16 +300,41 @@ class ImagesBatch(BasicImagesBatch):
 
     @action
     def convert_to_pil(self):
-        """ Convert batch data to PIL.Image format """
-        if self.images is None:
-            new_images = None
-        else:
-            new_images = np.asarray(list(None for _ in self.indices))
-            self.apply_transform(new_images, 'images', PIL.Image.fromarray)
+        """ Convert batch data to PIL.Image format
+
+        Images share memory with the source array whenever PIL allows it
+        (e.g. 8-bit grayscale or RGBA images from a C-contiguous array).
+        """
+        new_images = self._images_to_pil(self.images) if self.images is not None else None
         new_data = (new_images, self.labels)
         new_batch = ImagesPILBatch(np.arange(len(self)), preloaded=new_data)
         return new_batch
 
+    @staticmethod
+    def _images_to_pil(images):
+        """ Convert a sequence of image arrays to an object array of PIL.Images """
+        new_images = np.empty(len(images), dtype='object')
+        for i, image in enumerate(images):
+            new_images[i] = ImagesBatch._image_to_pil(image)
+        return new_images
+
+    @staticmethod
+    def _image_to_pil(image):
+        """ Convert one image array to PIL.Image without copying data if possible """
+        if image.ndim == 3 and image.shape[-1] == 1:
+            image = image[..., 0]
+        if image.dtype == np.uint8 and image.flags.c_contiguous:
+            if image.ndim == 2:
+                mode = 'L'
+            elif image.ndim == 3 and image.shape[-1] == 4:
+                mode = 'RGBA'
+            else:
+                mode = None
+            if mode is not None:
+                size = image.shape[1], image.shape[0]
+                return PIL.Image.frombuffer(mode, size, image, 'raw', mode, 0, 1)
+        return PIL.Image.fromarray(image)
+
     def _resize_one(self, ix, component='images', shape=None):
         """ Resize one image """
         image = self.get(ix, component)
@@ -304,41 +360,36 @@ class ImagesBatch(BasicImagesBatch):
 
     @staticmethod
     def _calc_origin(image, origin, shape):
-        if origin is None or origin == CROP_00:
-            origin = 0, 0
-        elif origin == CROP_CENTER:
-            origin_x = (image.shape[1] - shape[0]) // 2 if image.shape[1] > shape[0] else 0
-            origin_y = (image.shape[0] - shape[1]) // 2 if image.shape[0] > shape[1] else 0
-            origin = origin_x, origin_y
-        return origin
+        sizes = np.asarray([image.shape[1::-1]])
+        return tuple(calc_crop_origins(sizes, origin, shape)[0])
+
+    @staticmethod
+    def _get_sizes(images):
+        """ Return an array (N, 2) with sizes (width, height) of all images """
+        return np.tile(np.asarray(images.shape[2:0:-1]), (images.shape[0], 1))
 
     def _crop(self, component='images', origin=None, shape=None):
-        """ Crop all images in the batch """
+        """ Crop all images in the batch
+        origin could be also an array (N, 2) with a separate starting point for each image
+        """
         if origin is not None or shape is not None:
             images = self.get(None, component)
-
-            origin = self._calc_origin(images[0], origin, shape)
-            if shape is None:
-                shape = images.shape[2], images.shape[1]
-            if np.all(np.array(origin) + np.array(shape) > np.array(images.shape[1:3])):
-                shape = images.shape[2] - origin[0], images.shape[1] - origin[1]
-
-            x = slice(origin[0], origin[0] + shape[0])
-            y = slice(origin[1], origin[1] + shape[1])
-            new_images = images[:, y, x].copy()
-
+            sizes = self._get_sizes(images)
+            origins = calc_crop_origins(sizes, origin, shape)
+            shape = fit_crop_shape(sizes, origins, shape)
+            new_images = crop_numba(images, origins, shape)
             setattr(self, component, new_images)
 
     def _crop_image(self, image, origin, shape):
         origin = self._calc_origin(image, origin, shape)
-        new_image = image[origin[1]:origin[1] + shape[1], origin[0]:origin[1] + shape[0]].copy()
+        new_image = image[origin[1]:origin[1] + shape[1], origin[0]:origin[0] + shape[0]].copy()
         return new_image
 
     def _random_crop(self, component='images', shape=None):
         if shape is not None:
             images = self.get(None, component)
-            new_images = random_crop_numba(images, shape)
-            setattr(self, component, new_images)
+            origins = random_crop_origins(self._get_sizes(images), shape)
+            self._crop(component, origins, shape)
         return self
 
     @action
@@ -378,25 +429,43 @@ class ImagesPILBatch(BasicImagesBatch):
 
     @action
     def convert_to_array(self, dtype=np.uint8):
-        """ Convert images from PIL.Image format to an array """
-        if self.images is not None:
-            new_images = list(None for _ in self.indices)
-            self.apply_transform(new_images, 'images', self._convert_to_array_one, dtype=dtype)
-            new_images = np.stack(new_images)
-        else:
-            new_images = None
+        """ Convert images from PIL.Image format to an array
+
+        All images should have the same size and mode, as they are written
+        straight into one preallocated array of shape (N, H, W) or (N, H, W, C).
+        If some images are missing (None), an object array is created instead.
+        """
+        new_images = self._images_to_array(self.images, dtype) if self.images is not None else None
         new_data = new_images, self.labels
         new_batch = ImagesBatch(np.arange(len(self)), preloaded=new_data)
         return new_batch
 
+    def _images_to_array(self, images, dtype=None):
+        """ Convert a sequence of PIL.Images to one preallocated array
+        An empty sequence gives an empty array, while missing images (None) give an object array of arrays and None.
+        """
+        if len(images) == 0:
+            return np.empty(0, dtype=dtype)
+        if any(image is None for image in images):
+            new_images = np.empty(len(images), dtype='object')
+            for i, image in enumerate(images):
+                new_images[i] = self._convert_to_array_one(image, dtype)
+            return new_images
+        first_image = self._convert_to_array_one(images[0], dtype)
+        new_images = np.empty((len(images),) + first_image.shape, dtype=first_image.dtype)
+        new_images[0] = first_image
+        for i in range(1, len(images)):
+            image = self._convert_to_array_one(images[i], dtype)
+            if image.shape != first_image.shape:
+                raise ValueError("All images should have the same shape to be converted to an array",
+                                 first_image.shape, image.shape)
+            new_images[i] = image
+        return new_images
+
     def _convert_to_array_one(self, image, dtype=np.uint8):
+        """ Convert one PIL.Image to an array """
         if image is not None:
-            arr = np.fromstring(image.tobytes(), dtype=dtype)
-            if image.palette is None:
-                new_shape = (image.height, image.width)
-            else:
-                new_shape = (image.height, image.width, -1)
-            new_image = arr.reshape(*new_shape)
+            new_image = np.asarray(image, dtype=dtype)
         else:
             new_image = None
         return new_image
@@ -424,28 +493,41 @@ class ImagesPILBatch(BasicImagesBatch):
 
     def _crop_image(self, image, origin, shape):
         """ Crop one image """
-        if origin is None or origin == CROP_00:
-            origin = 0, 0
-        elif origin == CROP_CENTER:
-            origin = (image.width - shape[0]) // 2, (image.height - shape[1]) // 2
-        origin_x, origin_y = origin
+        origin_x, origin_y = calc_crop_origins(np.asarray([image.size]), origin, shape)[0]
         shape = shape if shape is not None else (image.width - origin_x, image.height - origin_y)
         box = origin_x, origin_y, origin_x + shape[0], origin_y + shape[1]
         return image.crop(box)
 
-    @inbatch_parallel('indices', post='assemble')
-    def _crop(self, ix, component='images', origin=None, shape=None):
-        """ Crop all images """
-        image = self.get(ix, component)
-        return self._crop_image(image, origin, shape)
+    @staticmethod
+    def _get_sizes(images):
+        """ Return an array (N, 2) with sizes (width, height) of all images """
+        return np.asarray([image.size for image in images])
 
-    @inbatch_parallel('indices', post='assemble')
-    def _random_crop(self, ix, component='images', shape=None):
+    def _crop(self, component='images', origin=None, shape=None):
+        """ Crop all images
+        Images of the same size and a common mode are cropped as one array with `crop_numba`,
+        otherwise each image is cropped separately with the requested shape.
+        """
+        images = self.get(None, component)
+        sizes = self._get_sizes(images)
+        origins = calc_crop_origins(sizes, origin, shape)
+
+        modes = set(image.mode for image in images)
+        if len(modes) == 1 and modes.pop() in ['L', 'RGB', 'RGBA'] and np.all(sizes == sizes[0]):
+            # crops of one array should have the same shape which fits into images
+            arrays = crop_numba(self._images_to_array(images), origins, fit_crop_shape(sizes, origins, shape))
+            new_images = ImagesBatch._images_to_pil(arrays)    # pylint: disable=protected-access
+        else:
+            new_images = np.empty(len(images), dtype='object')
+            for i, image in enumerate(images):
+                new_images[i] = self._crop_image(image, origins[i], shape)
+        setattr(self, component, new_images)
+
+    def _random_crop(self, component='images', shape=None):
         """ Crop all images with a given shape and a random origin """
-        image = self.get(ix, component)
-        origin_x = np.random.randint(0, image.width - shape[0])
-        origin_y = np.random.randint(0, image.height - shape[1])
-        return self._crop_image(image, (origin_x, origin_y), shape)
+        images = self.get(None, component)
+        origins = random_crop_origins(self._get_sizes(images), shape)
+        self._crop(component, origins, shape)
 
     @action
     @inbatch_parallel('indices', post='assemble')
@@ -1,5 +1,7 @@
 """ FullDataset """
 
+import threading
+import concurrent.futures as cf
 import numpy as np
 from .base import Baseset
 from .dsindex import DatasetIndex
@@ -7,38 +9,104 @@ from .dataset import Dataset
 from .pipeline import Pipeline
 
 
+def sort_keys(keys):
+    """ Sort keys once to find positions of any keys later
+    Return:
+        a tuple of sorted keys and their positions in the original array
+    """
+    keys = np.asarray(keys)
+    order = np.argsort(keys, kind='mergesort')
+    return keys[order], order
+
+
+def find_keys(sorted_keys, order, keys):
+    """ Find positions of keys in the original array (-1 for keys which are not found)
+    Args:
+        sorted_keys, order - the result of `sort_keys`
+        keys - an array of keys to look for
+    """
+    keys = np.asarray(keys)
+    found = np.searchsorted(sorted_keys, keys)
+    found[found == len(sorted_keys)] = 0
+    match = sorted_keys[found] == keys
+    return np.where(match, order[found], -1)
+
+
 class JointDataset(Baseset):
-    """ Dataset comprising several Datasets """
+    """ Dataset comprising several Datasets
+
+    Args:
+        datasets - a list of datasets or pipelines
+        align - how items in datasets correspond to each other:
+            'order' or True - items at the same positions go together (all indices should have the same length),
+            'same' or False - all datasets have the same index,
+            'inner' - items with the same index value go together, only values present in all datasets are used,
+            'left' - items with the same index value go together, all values from the first dataset are used.
+
+    With 'inner' and 'left' the join is made with sorted keys, so datasets might have indices
+    in a different order or cover different items. In 'left' mode batches from other datasets
+    contain only the items they have (in the order of the first dataset batch) or None if they have no items at all.
+    Use `get_positions` to find out which items are missing.
+    """
     def __init__(self, datasets, align='order', *args, **kwargs):
         if not isinstance(datasets, (list, tuple)) or len(datasets) == 0:
             raise TypeError("Expected a non-empty list-like with instances of Dataset or Pipeline.")
+        for dataset in datasets:
+            if not isinstance(dataset, (Dataset, Pipeline)):
+                raise TypeError("Dataset or Pipeline is expected, but instead %s was given." % type(dataset))
+
+        if isinstance(align, bool):
+            _align, join = align, None
+        elif align in ['same', 'order']:
+            _align, join = align == 'order', None
+        elif align in ['inner', 'left']:
+            # batch indices are the values of the joint index
+            _align, join = False, align
         else:
+            raise ValueError("align should be one of 'order', 'same', 'inner', 'left', True or False")
+
+        if join is None:
             index_len = None
             for dataset in datasets:
-                if not isinstance(dataset, (Dataset, Pipeline)):
-                    raise TypeError("Dataset or Pipeline is expected, but instead %s was given." % type(dataset))
                 ds_ilen = len(dataset.index)
                 if index_len is None:
                     index_len = ds_ilen
                 elif index_len != ds_ilen:
                     raise TypeError("All datasets should have indices of the same length.")
-
-        if isinstance(align, bool):
-            _align = align
-        elif align in ['same', 'order']:
-            _align = align == 'order'
+            self._sorted_keys = None
         else:
-            raise ValueError("align should be one of 'order', 'same', True or False")
+            self._sorted_keys = [sort_keys(dataset.indices) for dataset in datasets]
 
         self.align = _align
+        self.join = join
         self.datasets = datasets
-        super().__init__(datasets, self.align, *args, **kwargs)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        super().__init__(datasets, self.align, self.join, self._sorted_keys, *args, **kwargs)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        del state['_executor_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._executor_lock = threading.Lock()
 
 
     @staticmethod
-    def build_index(datasets, align):   # pylint: disable=arguments-differ
+    def build_index(datasets, align, join=None, sorted_keys=None):   # pylint: disable=arguments-differ
         """ Create a common index for all included datasets """
-        if align:
+        if join == 'inner':
+            keys = np.asarray(datasets[0].indices)
+            found = np.ones(len(keys), dtype=np.bool_)
+            for dataset_keys in sorted_keys[1:]:
+                found &= find_keys(*dataset_keys, keys) >= 0
+            return DatasetIndex(keys[found])
+        elif join == 'left':
+            return datasets[0].index
+        elif align:
             return DatasetIndex(np.arange(len(datasets[0])))
         else:
             return datasets[0].index
@@ -47,17 +115,58 @@ class JointDataset(Baseset):
     def create_subset(self, index):
         """ Create new JointDataset from a subset of indices """
         ds_set = list()
+        if self.join is not None:
+            for dataset, positions in zip(self.datasets, self.get_positions(index)):
+                positions = positions[positions >= 0]
+                ds_set.append(type(dataset).from_dataset(dataset, dataset.index.create_batch(positions, pos=True)))
+            return JointDataset(ds_set, align=self.join)
         ds_index = self.index.create_batch(index, pos=self.align)
         for dataset in self.datasets:
             ds_set.append(type(dataset).from_dataset(dataset, ds_index))
         return JointDataset(ds_set, align='same')
 
 
+    def _get_executor(self):
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = cf.ThreadPoolExecutor()
+        return self._executor
+
+    def get_positions(self, batch_indices):
+        """ Find positions of items in each dataset for index values of a joint dataset
+        Return:
+            an array of shape (number of datasets, number of items) with -1 for missing items
+        """
+        if isinstance(batch_indices, DatasetIndex):
+            batch_indices = batch_indices.indices
+        if self.join is None:
+            positions = self.index.get_pos(batch_indices) if not self.align else np.asarray(batch_indices)
+            return np.tile(positions, (len(self.datasets), 1))
+        return np.stack([find_keys(*keys, batch_indices) for keys in self._sorted_keys])
+
+    def _create_one_batch(self, dataset, batch_indices, *args, positions=None, **kwargs):
+        if positions is None:
+            return dataset.create_batch(batch_indices, self.align, *args, **kwargs)
+        positions = positions[positions >= 0]
+        if len(positions) == 0:
+            return None
+        return dataset.create_batch(positions, True, *args, **kwargs)
+
     def create_batch(self, batch_indices, pos=True, *args, **kwargs):
-        """ Create a list of batches from all source datasets """
-        ds_batches = list()
-        for dataset in self.datasets:
-            ds_batches.append(dataset.create_batch(batch_indices, pos=self.align, *args, **kwargs))
+        """ Create a list of batches from all source datasets
+        Batches are created concurrently, so loading data into them is overlapped.
+        """
+        if self.join is None:
+            all_positions = [None] * len(self.datasets)
+        else:
+            all_positions = self.get_positions(batch_indices)
+        futures = [self._get_executor().submit(self._create_one_batch, dataset, batch_indices, *args,
+                                               positions=positions, **kwargs)
+                   for dataset, positions in zip(self.datasets[1:], all_positions[1:])]
+        ds_batches = [self._create_one_batch(self.datasets[0], batch_indices, *args, positions=all_positions[0],
+                                             **kwargs)]
+        ds_batches += [future.result() for future in futures]
         return ds_batches
 
 
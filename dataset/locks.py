@@ -0,0 +1,78 @@
+""" Contains locks for actions """
+import time
+import threading
+
+
+class InstrumentedLock:
+    """ A reentrant lock which measures how long threads wait to acquire it """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.n_acquired = 0
+        self.wait_time = 0.
+        self.max_wait_time = 0.
+
+    def acquire(self, blocking=True, timeout=-1):
+        """ Acquire the lock """
+        start_time = time.perf_counter()
+        res = self._lock.acquire(blocking, timeout)
+        if res:
+            # counters are updated under the lock, so they are consistent
+            wait_time = time.perf_counter() - start_time
+            self.n_acquired += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+        return res
+
+    def release(self):
+        """ Release the lock """
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, trback):
+        self.release()
+
+    def stats(self):
+        """ Return a dict with the number of acquisitions, total and max wait time (in seconds) """
+        return dict(acquired=self.n_acquired, wait_time=self.wait_time, max_wait_time=self.max_wait_time)
+
+
+class KeyedLock:
+    """ A set of reentrant locks, one lock per key
+
+    Args:
+        stripes: int or None - if None, each key has its own lock,
+                 otherwise keys are hashed into a fixed number of locks
+
+    Usage:
+        file_locks = KeyedLock()
+        with file_locks.get_lock('/path/to/file'):
+            # only one thread writes to this file, while other files might be written at the same time
+            ...
+    """
+    def __init__(self, stripes=None):
+        self.stripes = stripes
+        self._locks = dict()
+        self._lock = threading.Lock()
+
+    def get_lock(self, key=None):
+        """ Return a lock for a given key """
+        if self.stripes is not None:
+            key = hash(key) % self.stripes
+        lock = self._locks.get(key)
+        if lock is None:
+            with self._lock:
+                lock = self._locks.setdefault(key, InstrumentedLock())
+        return lock
+
+    def stats(self):
+        """ Return lock statistics summed over all keys """
+        with self._lock:
+            locks = list(self._locks.values())
+        all_stats = [lock.stats() for lock in locks]
+        return dict(locks=len(all_stats),
+                    acquired=sum(stats['acquired'] for stats in all_stats),
+                    wait_time=sum(stats['wait_time'] for stats in all_stats),
+                    max_wait_time=max([stats['max_wait_time'] for stats in all_stats] or [0.]))
@@ -1,15 +1,37 @@
 """ Contains the base class for open datasets """
 
-from .. import Dataset
+import os
+import tempfile
+import urllib.request
+import numpy as np
+
+from .. import Dataset, DatasetIndex
 from ..image import ImagesBatch
 
 
 class Openset(Dataset):
-    """ The base class for open datasets """
-    def __init__(self, index=None, batch_class=None, train_test=False):
+    """ The base class for open datasets
+
+    Args:
+        index: an index or None to use all items
+        batch_class: a batch class
+        train_test: bool - whether data comes in train and test parts
+        cache_dir: str - a directory where extracted data is stored as .npy files,
+                   so that subsequent runs just open them memory-mapped.
+                   If None, a subdirectory of the system temp dir is used.
+                   If False, data is extracted on each run.
+        mirror: str - a local directory with source files to use instead of downloading them
+    """
+    COMPONENTS = None
+
+    def __init__(self, index=None, batch_class=None, train_test=False, cache_dir=None, mirror=None):
         self.train_test = train_test
+        self.mirror = mirror
+        if cache_dir is None:
+            cache_dir = os.path.join(tempfile.gettempdir(), 'dataset_cache', type(self).__name__)
+        self.cache_dir = cache_dir
         self._train_index, self._test_index = None, None
-        self._data = self.download()
+        self._data = self.load_data()
         preloaded = self._data if not train_test else None
         super().__init__(index, batch_class, preloaded=preloaded)
 
@@ -25,6 +47,66 @@ class Openset(Dataset):
         """ Download a dataset from the source web-site """
         return None
 
+    def get_source(self, url):
+        """ Return a local file name for a source url, downloading the file if it is not available locally """
+        filename = os.path.basename(url)
+        if self.mirror is not None:
+            localname = os.path.join(self.mirror, filename)
+            if os.path.isfile(localname):
+                return localname
+        localname = os.path.join(tempfile.gettempdir(), filename)
+        if not os.path.isfile(localname):
+            print("Downloading", filename, "...")
+            urllib.request.urlretrieve(url, localname)
+            print("Downloaded", filename)
+        return localname
+
+    @property
+    def _splits(self):
+        return ('train', 'test') if self.train_test else ('data',)
+
+    def _cache_files(self):
+        """ Return a list of cache file names for each split """
+        n_components = len(self.COMPONENTS or (None,))
+        return [[os.path.join(self.cache_dir, '%s_%d.npy' % (split, i)) for i in range(n_components)]
+                for split in self._splits]
+
+    def load_data(self):
+        """ Load data from the cache or download and extract it """
+        data = self._load_from_cache()
+        if data is None:
+            data = self.download()
+            if self._save_to_cache(data):
+                # release extracted arrays and use memory-mapped files instead
+                data = self._load_from_cache()
+        return data
+
+    def _load_from_cache(self):
+        if not self.cache_dir:
+            return None
+        files = self._cache_files()
+        if not all(os.path.isfile(name) for split_files in files for name in split_files):
+            return None
+        data = [tuple(np.load(name, mmap_mode='r') for name in split_files) for split_files in files]
+        if self.train_test:
+            self._train_index = DatasetIndex(np.arange(len(data[0][0])))
+            self._test_index = DatasetIndex(np.arange(len(data[1][0])))
+            return tuple(data)
+        return data[0]
+
+    def _save_to_cache(self, data):
+        if not self.cache_dir or data is None:
+            return False
+        os.makedirs(self.cache_dir, exist_ok=True)
+        split_data = data if self.train_test else (data,)
+        for split_files, components in zip(self._cache_files(), split_data):
+            for name, component in zip(split_files, components):
+                # write into a temporary file first so that an interrupted run leaves no broken cache
+                tmp_name = name + '.tmp.npy'
+                np.save(tmp_name, np.ascontiguousarray(component))
+                os.replace(tmp_name, name)
+        return True
+
     def cv_split(self, shares=0.8, shuffle=False):
         if self.train_test:
             train_data, test_data = self._data  # pylint:disable=unpacking-non-sequence
@@ -36,5 +118,7 @@ class Openset(Dataset):
 
 class ImagesOpenset(Openset):
     """ The base class for open datasets with images """
-    def __init__(self, index=None, batch_class=ImagesBatch, train_test=False):
-        super().__init__(index, batch_class, train_test)
+    COMPONENTS = 'images', 'labels'
+
+    def __init__(self, index=None, batch_class=ImagesBatch, train_test=False, cache_dir=None, mirror=None):
+        super().__init__(index, batch_class, train_test, cache_dir, mirror)
@@ -1,10 +1,8 @@
 """ Contains CIFAR datasets """
 
-import os
-import tempfile
-import urllib
 import pickle
 import tarfile
+import concurrent.futures as cf
 import numpy as np
 
 from .. import DatasetIndex
@@ -17,41 +15,65 @@ class BaseCIFAR(ImagesOpenset):
     LABELS_KEY = None
     TRAIN_NAME_ID = None
     TEST_NAME_ID = None
+    TRAIN_SIZE = 50000
+    TEST_SIZE = 10000
+    TRAIN_FILE_SIZE = None
+    TEST_FILE_SIZE = 10000
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, train_test=True, **kwargs)
         self.cv_split()
 
     def download(self):
-        """ Load data from a web site and extract into numpy arrays """
+        """ Load data from a web site and extract into numpy arrays
 
-        def _extract(archive_file, member):
-            return pickle.load(archive_file.extractfile(member), encoding='bytes')
+        The archive is read in one pass and pickled chunks are decoded in parallel as soon as they are read.
+        Each chunk is written by its worker straight into preallocated contiguous arrays of images (NHWC) and labels
+        at the position given by its file number (all files of a subset have the same known size) and then dropped.
+        """
 
-        def _gather_extracted(all_res):
-            images = np.concatenate([res[b'data'] for res in all_res]).reshape(-1, 3, 32, 32).transpose((0, 2, 3, 1))
-            labels = np.concatenate([res[self.LABELS_KEY] for res in all_res])
-            return images, labels
+        def _empty(n_items):
+            return np.empty((n_items, 32, 32, 3), dtype=np.uint8), np.empty(n_items, dtype=np.int64)
 
-        tmpdir = tempfile.gettempdir()
-        filename = os.path.basename(self.SOURCE_URL)
-        localname = os.path.join(tmpdir, filename)
-        if not os.path.isfile(localname):
-            print("Downloading", filename, "...")
-            urllib.request.urlretrieve(self.SOURCE_URL, localname)
-            print("Downloaded", filename)
+        def _extract(data, arrays, offset, file_size):
+            chunk = pickle.loads(data, encoding='bytes')
+            chunk_labels = chunk[self.LABELS_KEY]
+            if len(chunk_labels) != file_size:
+                raise ValueError("A CIFAR file should contain %d items, but it has %d" % (file_size, len(chunk_labels)))
+            images, labels = arrays
+            images[offset:offset + file_size] = chunk[b'data'].reshape(-1, 3, 32, 32).transpose((0, 2, 3, 1))
+            labels[offset:offset + file_size] = chunk_labels
 
-        print("Extracting...")
-        with tarfile.open(localname, "r:gz") as archive_file:
-            files_in_archive = archive_file.getmembers()
+        def _gather_extracted(futures, arrays, file_size):
+            for future in cf.as_completed(futures):
+                future.result()
+            n_items = len(futures) * file_size
+            return tuple(array[:n_items] for array in arrays)
 
-            data_files = [one_file for one_file in files_in_archive if self.TRAIN_NAME_ID in one_file.name]
-            all_res = [_extract(archive_file, one_file) for one_file in data_files]
-            train_data = _gather_extracted(all_res)
+        localname = self.get_source(self.SOURCE_URL)
 
-            test_files = [one_file for one_file in files_in_archive if self.TEST_NAME_ID in one_file.name]
-            all_res = [_extract(archive_file, one_file) for one_file in test_files]
-            test_data = _gather_extracted(all_res)
+        print("Extracting...")
+        train_data, test_data = _empty(self.TRAIN_SIZE), _empty(self.TEST_SIZE)
+        train_futures, test_futures = [], []
+        with cf.ThreadPoolExecutor() as executor:
+            with tarfile.open(localname, "r|gz") as archive_file:
+                for one_file in archive_file:
+                    if not one_file.isfile():
+                        continue
+                    if self.TRAIN_NAME_ID in one_file.name:
+                        futures, arrays, file_size = train_futures, train_data, self.TRAIN_FILE_SIZE
+                    elif self.TEST_NAME_ID in one_file.name:
+                        futures, arrays, file_size = test_futures, test_data, self.TEST_FILE_SIZE
+                    else:
+                        continue
+                    offset = len(futures) * file_size
+                    if offset + file_size > len(arrays[1]):
+                        raise ValueError("The archive contains more data files than expected", one_file.name)
+                    data = archive_file.extractfile(one_file).read()
+                    futures.append(executor.submit(_extract, data, arrays, offset, file_size))
+
+            train_data = _gather_extracted(train_futures, train_data, self.TRAIN_FILE_SIZE)
+            test_data = _gather_extracted(test_futures, test_data, self.TEST_FILE_SIZE)
         print("Extracted")
 
         self._train_index = DatasetIndex(np.arange(len(train_data[0])))
@@ -66,6 +88,7 @@ class CIFAR10(BaseCIFAR):
     LABELS_KEY = b"labels"
     TRAIN_NAME_ID = "data_batch"
     TEST_NAME_ID = "test_batch"
+    TRAIN_FILE_SIZE = 10000
 
 
 class CIFAR100(BaseCIFAR):
@@ -74,3 +97,4 @@ class CIFAR100(BaseCIFAR):
     LABELS_KEY = b"fine_labels"
     TRAIN_NAME_ID = "train"
     TEST_NAME_ID = "test"
+    TRAIN_FILE_SIZE = 50000
@@ -1,8 +1,5 @@
 """ Contains MNIST dataset """
 
-import os
-import tempfile
-import urllib
 import gzip
 import numpy as np
 
@@ -40,13 +37,7 @@ class MNIST(ImagesOpenset):
     @parallel(init='_get_from_urls', post='_gather_data')
     def download(self, url, content):    # pylint:disable=arguments-differ
         """ Load data from the web site """
-        tmpdir = tempfile.gettempdir()
-        filename = os.path.basename(url)
-        localname = os.path.join(tmpdir, filename)
-        if not os.path.isfile(localname):
-            urllib.request.urlretrieve(url, localname)
-            print("Downloaded", filename)
-
+        localname = self.get_source(url)
         with open(localname, 'rb') as f:
             data = self._extract_images(f) if content == 0 else self._extract_labels(f)
         return data
@@ -1,11 +1,11 @@
 """ Pipeline classes """
-import traceback
+import os
+import pickle
 import concurrent.futures as cf
 import threading
 #import multiprocessing as mpc
 import asyncio
 import logging
-import queue as q
 import numpy as np
 try:
     import tensorflow as tf
@@ -16,12 +16,19 @@ from .batch_base import BaseBatch
 from .base import Baseset
 from .exceptions import SkipBatchException
 from .decorators import ModelDirectory
+from .server import InferenceServer
+from .variables import ShardedVariable, make_variable
+from .rebatch import RebatchGenerator
+from .cache import PrefixCache, fingerprint
+from .tuning import get_concurrency_budget
+from .prefetch import Prefetcher
 
 
 PIPELINE_ID = '#_pipeline'
 JOIN_ID = '#_join'
 MERGE_ID = '#_merge'
 REBATCH_ID = '#_rebatch'
+CACHE_ID = '#_cache'
 IMPORT_MODEL_ID = '#_import_model'
 INIT_MODEL_ID = '#_init_model'
 
@@ -61,15 +68,17 @@ class Pipeline:
 
         self._variables_lock = threading.Lock()
         self._tf_session = None
+        self._join_lock = threading.Lock()
+        self._join_executor = None
+        self._cache_keys = dict()
 
-        self._stop_flag = False
-        self._executor = None
-        self._service_executor = None
-        self._prefetch_count = None
-        self._prefetch_queue = None
-        self._batch_queue = None
+        self._prefetcher = None
         self._batch_generator = None
-        self._rest_batch = None
+        self._rebatch = None
+        self._iter_params = None
+        self._iter_state = None
+        self._restored_state = None
+        self._run_stats = dict(batches=0, skipped=0, errors=0)
 
         self.reset_iter()
 
@@ -199,6 +208,9 @@ class Pipeline:
         self.dataset = state['dataset']
         self._action_list = state['action_list']
         self._variables = state['variables']
+        self._join_lock = threading.Lock()
+        self._join_executor = None
+        self._cache_keys = dict()
 
     @property
     def index(self):
@@ -237,9 +249,12 @@ class Pipeline:
         if name not in self._variables:
             self.init_variable(name, default, init, init_on_each_run)
         var = self._variables.get(name)
-        return var.get('value', default)
+        value = var.get('value', default)
+        if isinstance(value, ShardedVariable):
+            value = value.get()
+        return value
 
-    def init_variable(self, name, default=None, init=None, init_on_each_run=False):
+    def init_variable(self, name, default=None, init=None, init_on_each_run=False, op=None, **op_kwargs):
         """ Create a variable if not exists.
         If the variable exists, does nothing.
         Args:
@@ -247,6 +262,9 @@ class Pipeline:
             default - an initial value for the variable
             init: callable - a function which returns the default value
             init_on_each_run: bool - whether to initialize the variable before each run / gen_batch
+            op: string - an operation for `update_variable`, one of 'add', 'append', 'max', 'min', 'sample'.
+                Such variables might be updated from many threads at once without locks and lost updates.
+            op_kwargs - additional parameters for an operation, e.g. `size` for 'sample'
         Return:
             self - in order to use it in the pipeline chains
 
@@ -254,13 +272,15 @@ class Pipeline:
             pp = dataset.p.
                     .init_variable("loss_history", init=list, init_on_each_run=True)
                     .init_variable("accuracy", default=0)
+                    .init_variable("items_count", default=0, op='add')
                     .load('/some/path', fmt='blosc')
                     .train_resnet()
         """
         if name not in self._variables:
             with self._variables_lock:
                 if name not in self._variables:
-                    self._variables[name] = dict(default=default, init=init, init_on_each_run=init_on_each_run)
+                    self._variables[name] = dict(default=default, init=init, init_on_each_run=init_on_each_run,
+                                                 op=op, op_kwargs=op_kwargs)
                     self.set_variable(name, default if init is None else init())
         return self
 
@@ -300,7 +320,38 @@ class Pipeline:
         """
         if name not in self._variables:
             logging.warning("Pipeline variable '%s' was not initialized", name)
-        self._variables[name].update({'value': value})
+            self._variables[name] = dict(default=None, init=None, init_on_each_run=False, op=None, op_kwargs={})
+        var = self._variables[name]
+        if var.get('op') is None:
+            var.update({'value': value})
+        elif isinstance(var.get('value'), ShardedVariable):
+            var['value'].set(value)
+        else:
+            var.update({'value': make_variable(var['op'], value, **var['op_kwargs'])})
+        return self
+
+    def update_variable(self, name, value):
+        """ Update a variable with its operation (see `init_variable`)
+        It is safe to call from parallel actions and prefetched batches as each thread updates its own copy
+        of the variable, which are merged when the variable is read.
+        Args:
+            name: string - a name of the variable
+            value - a value to add, append, compare or sample
+        Return:
+            self - in order to use it in the pipeline chains
+
+        Examples:
+            pp.init_variable("loss_history", op='append')
+            ...
+            # in an action
+            self.pipeline.update_variable("loss_history", loss)
+        """
+        if name not in self._variables:
+            raise KeyError("Pipeline variable '%s' does not exist" % name)
+        var = self._variables[name].get('value')
+        if not isinstance(var, ShardedVariable):
+            raise ValueError("Pipeline variable '%s' was initialized without op" % name)
+        var.update(value)
         return self
 
     def assign_variable(self, name, value):
@@ -383,18 +434,64 @@ class Pipeline:
                 batch = self._exec_all_actions(batch, action['pipeline']._action_list)  # pylint: disable=protected-access
         return batch
 
+    @staticmethod
+    def _describe_actions(action_list):
+        """ Return names and arguments of actions (including nested and joined pipelines) """
+        res = []
+        for action in action_list:
+            # pylint: disable=protected-access
+            if action['name'] == PIPELINE_ID:
+                nested = Pipeline._describe_actions(action['pipeline']._action_list)
+                res.append((action['name'], nested, action['proba'], action['repeat']))
+            elif action['name'] in [JOIN_ID, MERGE_ID]:
+                joined = [Pipeline._describe_actions(pipe._action_list) for pipe in action['pipelines']]
+                res.append((action['name'], action['mode'], action.get('merge_fn'), joined))
+            elif action['name'] == CACHE_ID:
+                pass
+            else:
+                res.append((action['name'], action.get('args'), action.get('kwargs'),
+                            action.get('proba'), action.get('repeat')))
+        return res
+
+    def _get_cache_key(self, batch, action_list, cache_pos):
+        """ Return a fingerprint of actions before the cache, the dataset index and the batch class """
+        memo_key = id(action_list[cache_pos]), type(batch)
+        key = self._cache_keys.get(memo_key)
+        if key is None:
+            index = self.dataset.index if self.dataset is not None else None
+            key = fingerprint(self._describe_actions(action_list[:cache_pos]),
+                              getattr(index, 'fingerprint', None), type(batch).__module__, type(batch).__name__)
+            self._cache_keys[memo_key] = key
+        return key
+
+    def _exec_cached_actions(self, batch, action_list, cache_pos):
+        """ Execute actions before the cache or take their results from the cache """
+        cache = action_list[cache_pos]['cache']
+        key = self._get_cache_key(batch, action_list, cache_pos)
+        cached_batch = cache.get(key, batch)
+        if cached_batch is not None:
+            return cached_batch
+        indices = np.asarray(batch.indices)
+        batch = self._exec_all_actions(batch, action_list[:cache_pos])
+        new_indices = np.asarray(batch.indices)
+        # items are found by their indices before the actions, so they should be kept in the same order,
+        # while some actions re-index a batch by item positions
+        if len(new_indices) == len(indices) and (np.array_equal(new_indices, indices) or
+                                                 np.array_equal(new_indices, np.arange(len(indices)))):
+            cache.put(key, batch, indices)
+        return batch
+
     def _exec_all_actions(self, batch, action_list=None):
         join_batches = None
-        action_list = action_list or self._action_list
+        action_list = self._action_list if action_list is None else action_list
+        cache_pos = [i for i, action in enumerate(action_list) if action['name'] == CACHE_ID]
+        if len(cache_pos) > 0:
+            batch = self._exec_cached_actions(batch, action_list, cache_pos[-1])
+            batch.pipeline = self
+            action_list = action_list[cache_pos[-1] + 1:]
         for _action in action_list:
             if _action['name'] in [JOIN_ID, MERGE_ID]:
-                join_batches = []
-                for pipe in _action['pipelines']:   # pylint: disable=not-an-iterable
-                    if _action['mode'] == 'i':
-                        jbatch = pipe.create_batch(batch.index)
-                    elif _action['mode'] == 'n':
-                        jbatch = pipe.next_batch()
-                    join_batches.append(jbatch)
+                join_batches = self._create_join_batches(batch, _action)
 
                 if _action['name'] == MERGE_ID:
                     if _action['merge_fn'] is None:
@@ -424,6 +521,28 @@ class Pipeline:
                     self._put_batch_into_tf_queue(batch, _action)
         return batch
 
+    def _get_join_executor(self):
+        if self._join_executor is None:
+            with self._join_lock:
+                if self._join_executor is None:
+                    self._join_executor = cf.ThreadPoolExecutor()
+        return self._join_executor
+
+    def _create_join_batches(self, batch, action):
+        """ Create batches from all joined pipelines
+        Batches with the same index (mode 'i') are created concurrently, so the join takes
+        as long as the slowest pipeline rather than the sum of them all.
+        """
+        pipelines = action['pipelines']
+        if action['mode'] == 'n':
+            return [pipe.next_batch() for pipe in pipelines]
+        if len(pipelines) == 1:
+            return [pipelines[0].create_batch(batch.index)]
+        futures = [self._get_join_executor().submit(pipe.create_batch, batch.index) for pipe in pipelines[1:]]
+        join_batches = [pipelines[0].create_batch(batch.index)]
+        join_batches += [future.result() for future in futures]
+        return join_batches
+
     def _needs_exec(self, action):
         if action['proba'] is None:
             return True
@@ -438,6 +557,14 @@ class Pipeline:
         batch_res.pipeline = self
         return batch_res
 
+    def _exec_prefetched(self, batch):
+        """ Execute actions for a batch in a prefetching worker within the concurrency budget """
+        budget = get_concurrency_budget()
+        if budget is None:
+            return self._exec(batch, new_loop=True)
+        with budget.slot():
+            return self._exec(batch, new_loop=True)
+
     def init_model(self, model_name, config=None):
         """ Initialize a static model
         Args:
@@ -479,6 +606,27 @@ class Pipeline:
                                    'pipeline': self, 'merge_fn': merge_fn})
         return new_p.append_action()
 
+    def cache(self, max_bytes=None, path=None):
+        """ Cache results of all previous actions for each item
+        In the first epoch batches are processed as usual and their data are stored after the previous actions.
+        Later batches made of cached items are taken from the cache and only the following actions are executed.
+        Actions before the cache should be deterministic, i.e. without random arguments, `proba` and models.
+        Args:
+            max_bytes: int or None - the maximum size of cached data (None means unlimited)
+            path: str or None - a directory to keep cached data on disk instead of memory
+        """
+        for action in self._action_list:
+            if action.get('proba') is not None:
+                raise ValueError("Actions before cache should be deterministic, but '%s' is executed with a probability"
+                                 % action['name'])
+        self._action_list.append({'name': CACHE_ID, 'cache': PrefixCache(max_bytes, path)})
+        return self.append_action()
+
+    def get_cache(self):
+        """ Return the last cache in the pipeline (see `cache`) or None """
+        caches = [action['cache'] for action in self._action_list if action['name'] == CACHE_ID]
+        return caches[-1] if len(caches) > 0 else None
+
     def put_into_tf_queue(self, session=None, queue=None, get_tensor=None):
         """ Insert a tensorflow queue after the action"""
         if len(self._action_list) > 0:
@@ -506,7 +654,7 @@ class Pipeline:
             action['tf_session'] = self._tf_session
         if action['tf_session'] is None:
             raise ValueError("Tensorflow session cannot be None")
-        maxsize = 1 if self._prefetch_queue is None else self._prefetch_queue.maxsize
+        maxsize = 1 if self._prefetcher is None else self._prefetcher.prefetch
         with action['tf_session'].graph.as_default():
             action['tf_queue'] = tf.FIFOQueue(capacity=maxsize, dtypes=self._get_dtypes(tensors, action))
 
@@ -539,70 +687,26 @@ class Pipeline:
         action['tf_session'].run(action['tf_enqueue_op'], feed_dict=dict(zip(action['tf_placeholders'], tensors)))
 
 
-    def _put_batches_into_queue(self, gen_batch):
-        while not self._stop_flag:
-            self._prefetch_count.put(1, block=True)
-            try:
-                batch = next(gen_batch)
-            except StopIteration:
-                break
-            else:
-                future = self._executor.submit(self._exec, batch, new_loop=True)
-                self._prefetch_queue.put(future, block=True)
-        self._prefetch_queue.put(None, block=True)
-
-    def _run_batches_from_queue(self):
-        skip_batch = False
-        while not self._stop_flag:
-            future = self._prefetch_queue.get(block=True)
-            if future is None:
-                self._prefetch_queue.task_done()
-                self._batch_queue.put(None)
-                break
-            else:
-                try:
-                    batch = future.result()
-                except SkipBatchException:
-                    skip_batch = True
-                except Exception:   # pylint: disable=broad-except
-                    exc = future.exception()
-                    print("Exception in a thread:", exc)
-                    traceback.print_tb(exc.__traceback__)
-                finally:
-                    if not skip_batch:
-                        self._batch_queue.put(batch, block=True)
-                        skip_batch = False
-                    self._prefetch_queue.task_done()
-        return None
+    def run_stats(self):
+        """ Return the number of batches returned, skipped (with SkipBatchException) and failed in the current run
+
+        With `prefetch='auto'` it also contains the current and the maximum prefetch depth,
+        with `max_prefetch_bytes` - the current and the peak size of prefetched batches.
+        """
+        stats = dict(self._run_stats)
+        if self._prefetcher is not None:
+            stats.update(self._prefetcher.stats())
+        return stats
 
     def reset_iter(self):
         """ Clear all iteration metadata in order to start iterating from scratch """
-        def _clear_queue(queue):
-            if queue is not None:
-                while not queue.empty():
-                    queue.get(block=True)
-                    queue.task_done()
-
-        def _stop_executor(executor):
-            if executor is not None:
-                executor.shutdown()
-
-        self._stop_flag = True
-
-        _clear_queue(self._prefetch_queue)
-        _clear_queue(self._batch_queue)
-        _clear_queue(self._prefetch_count)
-
-        _stop_executor(self._executor)
-        _stop_executor(self._service_executor)
-
-        self._executor = None
-        self._service_executor = None
-        self._prefetch_count = None
-        self._prefetch_queue = None
-        self._batch_queue = None
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+        self._prefetcher = None
         self._batch_generator = None
-        self._rest_batch = None
+        self._rebatch = None
+        self._iter_params = None
+        self._iter_state = None
 
         if self.dataset is not None:
             self.dataset.reset_iter()
@@ -610,82 +714,182 @@ class Pipeline:
         self._init_variables_before_run()
 
 
-    def gen_rebatch(self, *args, **kwargs):
-        """ Generate batches for rebatch operation """
-        _action = self._action_list[0]
-        self._rest_batch = None
-        while True:
-            if self._rest_batch is None:
-                cur_len = 0
-                batches = []
-            else:
-                cur_len = len(self._rest_batch)
-                batches = [self._rest_batch]
-                self._rest_batch = None
-            while cur_len < _action['batch_size']:
-                try:
-                    new_batch = _action['pipeline'].next_batch(*args, **kwargs)
-                except StopIteration:
-                    break
-                else:
-                    batches.append(new_batch)
-                    cur_len += len(new_batch)
-            if len(batches) == 0:
-                break
+    def gen_rebatch(self, *args, leftovers=None, **kwargs):
+        """ Generate batches for rebatch operation
+        leftovers is a list of batches with items left from a previous run (see `get_state`)
+        """
+        action = self._action_list[0]
+        self._rebatch = RebatchGenerator(action['pipeline'], action['batch_size'], action['merge_fn'])
+        yield from self._rebatch.gen(*args, leftovers=leftovers, **kwargs)
+
+    def _has_rebatch(self):
+        return len(self._action_list) > 0 and self._action_list[0]['name'] == REBATCH_ID
+
+    def _get_iter_state(self):
+        """ Return the iteration state right after a batch has been generated
+        Index params are just copied here and rebatch only refers to incoming batches,
+        while `_export_iter_state` turns them into a state to be saved.
+        """
+        state = dict()
+        if self._iter_params is not None:
+            state['index'] = dict(self._iter_params)
+        if self._has_rebatch():
+            state['pipeline'] = self._action_list[0]['pipeline']._iter_state    # pylint: disable=protected-access
+            state['rebatch'] = self._rebatch.get_state() if self._rebatch else None
+        return state
+
+    def _export_iter_state(self, state):
+        """ Return the iteration state which can be saved and restored """
+        if state is None:
+            return None
+        state = dict(state)
+        if state.get('index') is not None:
+            state['index'] = self.index.get_state(state['index'])
+        if 'pipeline' in state:
+            pipeline = self._action_list[0]['pipeline']
+            state['pipeline'] = pipeline._export_iter_state(state['pipeline'])    # pylint: disable=protected-access
+            state['rebatch'] = RebatchGenerator.get_leftovers(state['rebatch']) if state['rebatch'] else []
+        return state
+
+    def _gen_with_state(self, batch_generator):
+        """ Yield batches along with the iteration state after each of them """
+        for batch in batch_generator:
+            yield batch, self._get_iter_state()
+
+    def get_state(self):
+        """ Return a state to resume iteration from
+        The state includes the order of items and the position in it for the last batch which has been returned,
+        random state, items left from rebatch and pipeline variables (except those which cannot be pickled).
+        """
+        variables = dict()
+        for name in self._variables:
+            value = self.get_variable(name)
+            try:
+                pickle.dumps(value)
+            except Exception:   # pylint: disable=broad-except
+                logging.warning("Pipeline variable '%s' cannot be pickled and will not be saved", name)
             else:
-                if _action['merge_fn'] is None:
-                    batch, self._rest_batch = batches[0].merge(batches, batch_size=_action['batch_size'])
-                else:
-                    batch, self._rest_batch = _action['merge_fn'](batches, batch_size=_action['batch_size'])
-                yield batch
+                variables[name] = value
+        return dict(iteration=self._export_iter_state(self._iter_state), variables=variables)
 
+    def set_state(self, state):
+        """ Restore variables and make the next run continue from a state saved with `get_state`
+        Return:
+            self - in order to use it in the pipeline chains
+        """
+        self.reset_iter()
+        for name, value in state['variables'].items():
+            self.set_variable(name, value)
+        self._restored_state = state['iteration']
+        return self
+
+    def save_state(self, path):
+        """ Save the iteration state into a file
+        The file is written atomically, so an interruption does not spoil the previous checkpoint.
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(self.get_state(), file)
+        os.replace(tmp_path, path)
+        return self
+
+    def load_state(self, path):
+        """ Load the iteration state from a file saved with `save_state` """
+        with open(path, 'rb') as file:
+            state = pickle.load(file)
+        return self.set_state(state)
 
     def gen_batch(self, batch_size, shuffle=True, n_epochs=1, drop_last=False, prefetch=0, *args, **kwargs):
-        """ Generate batches """
+        """ Generate batches
+
+        `prefetch='auto'` adjusts the number of batches processed in advance while iterating,
+        up to `max_prefetch` (the number of CPUs by default).
+        `max_prefetch_bytes` limits the total size of prefetched batches.
+        """
         target = kwargs.pop('target', 'threads')
+        prefetch_kwargs = dict(max_prefetch=kwargs.pop('max_prefetch', None),
+                               max_prefetch_bytes=kwargs.pop('max_prefetch_bytes', None))
         self._tf_session = kwargs.pop('tf_session', None)
 
-        if len(self._action_list) > 0 and self._action_list[0]['name'] == REBATCH_ID:
-            batch_generator = self.gen_rebatch(batch_size, shuffle, n_epochs, drop_last, prefetch, *args, **kwargs)
+        state, self._restored_state = self._restored_state or {}, None
+        self._run_stats = dict(batches=0, skipped=0, errors=0)
+        self._prefetcher = None
+        # a pipeline before rebatch gets the same prefetch settings
+        rebatch_kwargs = {**kwargs, **{key: value for key, value in prefetch_kwargs.items() if value is not None}}
+        batch_generator = self._gen_source_batches(state, batch_size, shuffle, n_epochs, drop_last, prefetch, *args,
+                                                   rebatch_kwargs=rebatch_kwargs, **kwargs)
+        batch_generator = self._gen_with_state(batch_generator)
+
+        if prefetch == 'auto' or prefetch > 0:
+            self._prefetcher = Prefetcher(self._exec_prefetched, prefetch, target=target, run_stats=self._run_stats,
+                                          **prefetch_kwargs)
+            yield from self._gen_prefetched(self._prefetcher, batch_generator)
         else:
-            batch_generator = self.dataset.gen_batch(batch_size, shuffle, n_epochs, drop_last, *args, **kwargs)
+            yield from self._gen_sequential(batch_generator)
 
-        if prefetch > 0:
-            # pool cannot have more than 63 workers
-            prefetch = min(prefetch, 62)
-
-            if target in ['threads', 't']:
-                self._executor = cf.ThreadPoolExecutor(max_workers=prefetch + 1)
-            elif target in ['mpc', 'm']:
-                self._executor = cf.ProcessPoolExecutor(max_workers=prefetch + 1)   # pylint: disable=redefined-variable-type
+    def _gen_source_batches(self, state, *args, rebatch_kwargs=None, **kwargs):
+        """ Return a generator of batches from the dataset (or from the pipeline before rebatch)
+        which continues iteration from a restored state
+        Args:
+            args: batch_size, shuffle, n_epochs, drop_last, prefetch and other `gen_batch` args
+        """
+        if self._has_rebatch():
+            pipeline = self._action_list[0]['pipeline']
+            if 'pipeline' in state:
+                pipeline._restored_state = state['pipeline']    # pylint: disable=protected-access
+                pipeline._batch_generator = None                # pylint: disable=protected-access
+            return self.gen_rebatch(*args, leftovers=state.get('rebatch'), **rebatch_kwargs)
+        batch_size, shuffle, n_epochs, drop_last, _, *args = args
+        self._iter_params = self.index.get_default_iter_params()
+        if state.get('index') is not None:
+            self.index.set_state(state['index'], self._iter_params)
+        return self.dataset.gen_batch(batch_size, shuffle, n_epochs, drop_last, *args,
+                                      iter_params=self._iter_params, **kwargs)
+
+    def _gen_prefetched(self, prefetcher, batch_generator):
+        """ Yield batches processed in advance """
+        processed = prefetcher.run(batch_generator)
+        try:
+            for batch_res, state in processed:
+                self._iter_state = state
+                self._run_stats['batches'] += 1
+                yield batch_res
+        finally:
+            processed.close()
+
+    def _gen_sequential(self, batch_generator):
+        """ Yield batches processed one after another """
+        for batch, state in batch_generator:
+            try:
+                batch_res = self._exec(batch)
+            except SkipBatchException:
+                self._iter_state = state
+                self._run_stats['skipped'] += 1
+            except Exception:
+                self._run_stats['errors'] += 1
+                raise
             else:
-                raise ValueError("target should be one of ['threads', 'mpc']")
-
-            self._stop_flag = False
-            self._prefetch_count = q.Queue(maxsize=prefetch + 1)
-            self._prefetch_queue = q.Queue(maxsize=prefetch)
-            self._batch_queue = q.Queue(maxsize=1)
-            self._service_executor = cf.ThreadPoolExecutor(max_workers=2)
-            self._service_executor.submit(self._put_batches_into_queue, batch_generator)
-            self._service_executor.submit(self._run_batches_from_queue)
-
-            while not self._stop_flag:
-                batch_res = self._batch_queue.get(block=True)
-                self._batch_queue.task_done()
-                if batch_res is not None:
-                    yield batch_res
-                    self._prefetch_count.get(block=True)
-                    self._prefetch_count.task_done()
-                else:
-                    self._stop_flag = True
-        else:
-            for batch in batch_generator:
-                try:
-                    batch_res = self._exec(batch)
-                except SkipBatchException:
-                    pass
-                else:
-                    yield batch_res
+                self._iter_state = state
+                self._run_stats['batches'] += 1
+                yield batch_res
+
+    def execute_for(self, batch, new_loop=False):
+        """ Execute all lazy actions for a given batch
+        Args:
+            batch: an instance of some batch class
+            new_loop: bool - whether to create a new async loop (e.g. when called from a new thread)
+        Return:
+            a processed batch
+        """
+        return self._exec(batch, new_loop)
+
+    def serve(self, *, batch_size=32, timeout=0.01, **kwargs):
+        """ Start a server which processes items arriving one at a time in micro-batches
+        See `InferenceServer` for all arguments (they should be given as keyword arguments).
+        Return:
+            a running InferenceServer
+        """
+        return InferenceServer(self, batch_size=batch_size, timeout=timeout, **kwargs).start()
 
     def create_batch(self, batch_index, *args, **kwargs):
         """ Create a new batch by given indices and execute all previous lazy actions """
@@ -0,0 +1,223 @@
+""" Contains a prefetcher which processes batches in advance in background threads """
+import time
+import queue as q
+import functools
+import threading
+import concurrent.futures as cf
+
+from .exceptions import SkipBatchException
+from .cache import batch_nbytes
+from .tuning import PrefetchTuner, SlotQueue, MemoryBudget, cpu_count
+
+
+# how often threads waiting for prefetch queues check whether the iteration has been stopped (in seconds)
+QUEUE_TIMEOUT = 0.1
+# pool cannot have more than 63 workers
+MAX_PREFETCH = 62
+
+
+class Prefetcher:
+    """ Process batches in advance while the consumer handles previous batches
+
+    A producer thread takes batches from a generator and submits them to workers,
+    while a runner thread waits for them in order and passes processed batches to the consumer.
+    Skipped batches (with SkipBatchException) are dropped and replaced with new ones,
+    while an error stops the iteration and is raised in the consumer.
+
+    Args:
+        exec_batch: callable - a function which takes a batch and returns a processed batch
+        prefetch: int - the number of batches processed in advance
+                  'auto' - adjust the number at runtime up to `max_prefetch` (the number of CPUs by default)
+        target: str - 'threads' or 'mpc' (processes)
+        max_prefetch: int or None - the maximum number of batches for `prefetch='auto'`
+        max_prefetch_bytes: int or None - the maximum total size of prefetched batches
+        run_stats: dict - counters of skipped and failed batches which are updated while iterating
+
+    Usage:
+        prefetcher = Prefetcher(pipeline.execute_for, prefetch=4)
+        for batch, state in prefetcher.run(gen_batch_with_state):
+            ...
+    """
+    def __init__(self, exec_batch, prefetch, *, target='threads', max_prefetch=None, max_prefetch_bytes=None,
+                 run_stats=None):
+        if target not in ['threads', 't', 'mpc', 'm']:
+            raise ValueError("target should be one of ['threads', 'mpc']")
+        self.exec_batch = exec_batch
+        self.target = target
+        self.tuner = None
+        if prefetch == 'auto':
+            self.tuner = PrefetchTuner(depth=1, max_depth=min(max_prefetch or cpu_count(), MAX_PREFETCH))
+            prefetch = self.tuner.max_depth
+        self.prefetch = min(prefetch, MAX_PREFETCH)
+        self.memory_budget = MemoryBudget(max_prefetch_bytes) if max_prefetch_bytes is not None else None
+        self.run_stats = run_stats if run_stats is not None else dict(skipped=0, errors=0)
+
+        self._stop_flag = False
+        self._executor = None
+        self._service_threads = []
+        depth = self.prefetch if self.tuner is None else self.tuner.depth
+        self._prefetch_count = SlotQueue(maxsize=depth + 1)
+        self._prefetch_queue = q.Queue(maxsize=self.prefetch)
+        self._batch_queue = q.Queue(maxsize=1)
+
+    def run(self, batch_generator):
+        """ Start prefetching batches from a generator of (batch, state)
+        Return:
+            a generator of processed batches with their states (prefetching stops when it is closed)
+        """
+        if self.target in ['threads', 't']:
+            self._executor = cf.ThreadPoolExecutor(max_workers=self.prefetch + 1)
+        else:
+            self._executor = cf.ProcessPoolExecutor(max_workers=self.prefetch + 1)   # pylint: disable=redefined-variable-type
+        # an abandoned iteration is not stopped, so service threads should not keep the interpreter from exiting
+        self._service_threads = [threading.Thread(target=self._put_batches_into_queue, args=(batch_generator,),
+                                                  daemon=True),
+                                 threading.Thread(target=self._run_batches_from_queue, daemon=True)]
+        for thread in self._service_threads:
+            thread.start()
+        return self._gen_processed()
+
+    def _gen_processed(self):
+        try:
+            while True:
+                start_time = time.perf_counter()
+                item = self._get_from_queue(self._batch_queue)
+                if item is None:
+                    break
+                batch_res, state, exc, nbytes = item
+                if exc is not None:
+                    # the exception keeps the traceback from the thread where it was raised
+                    raise exc
+                wait_time = time.perf_counter() - start_time
+                yield batch_res, state
+                if self.tuner is not None:
+                    busy_time = time.perf_counter() - start_time - wait_time
+                    depth = self.tuner.update(wait_time, busy_time)
+                    self._prefetch_count.resize(depth + 1)
+                self._release_memory(nbytes)
+                self._get_from_queue(self._prefetch_count)
+        finally:
+            # stop prefetching when the iteration is over, failed or abandoned
+            self.stop()
+
+    def stop(self):
+        """ Stop prefetching threads and wait until they finish """
+        self._stop_flag = True
+        for thread in self._service_threads:
+            thread.join()
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._executor = None
+        self._service_threads = []
+
+    def stats(self):
+        """ Return a dict with prefetch depth (for `prefetch='auto'`) and the size of prefetched batches """
+        stats = dict()
+        for tool in (self.tuner, self.memory_budget):
+            if tool is not None:
+                stats.update(('prefetch_' + key, value) for key, value in tool.stats().items())
+        return stats
+
+    def _put_into_queue(self, queue, item):
+        """ Put an item into a queue unless the iteration has been stopped
+        Return:
+            True if the item has been put
+        """
+        while not self._stop_flag:
+            try:
+                queue.put(item, timeout=QUEUE_TIMEOUT)
+            except q.Full:
+                pass
+            else:
+                return True
+        return False
+
+    def _get_from_queue(self, queue):
+        """ Get an item from a queue or None if the iteration has been stopped """
+        while not self._stop_flag:
+            try:
+                item = queue.get(timeout=QUEUE_TIMEOUT)
+            except q.Empty:
+                pass
+            else:
+                queue.task_done()
+                return item
+        return None
+
+    def _reserve_memory(self):
+        """ Wait until a new batch fits into the prefetch memory budget
+        Return:
+            the number of reserved bytes or None if the iteration has been stopped
+        """
+        if self.memory_budget is None:
+            return 0
+        while not self._stop_flag:
+            reserved = self.memory_budget.reserve(timeout=QUEUE_TIMEOUT)
+            if reserved is not None:
+                return reserved
+        return None
+
+    def _release_memory(self, nbytes, reserved=False):
+        if self.memory_budget is not None:
+            if reserved:
+                self.memory_budget.cancel(nbytes)
+            else:
+                self.memory_budget.release(nbytes)
+
+    def _put_batches_into_queue(self, gen_batch):
+        try:
+            while self._put_into_queue(self._prefetch_count, 1):
+                reserved = self._reserve_memory()
+                if reserved is None:
+                    break
+                try:
+                    batch, state = next(gen_batch)
+                except StopIteration:
+                    self._release_memory(reserved, reserved=True)
+                    break
+                except Exception as exc:   # pylint: disable=broad-except
+                    # an error while creating a batch is passed to the consumer as well
+                    future, state = cf.Future(), None
+                    future.set_exception(exc)
+                else:
+                    try:
+                        future = self._executor.submit(self.exec_batch, batch)
+                    except RuntimeError:
+                        # workers are shut down when the interpreter exits
+                        self._release_memory(reserved, reserved=True)
+                        break
+                    if self.tuner is not None:
+                        future.add_done_callback(functools.partial(self._add_producer_time, time.perf_counter()))
+                if not self._put_into_queue(self._prefetch_queue, (future, state, reserved)):
+                    break
+        finally:
+            self._put_into_queue(self._prefetch_queue, None)
+            gen_batch.close()
+
+    def _add_producer_time(self, start_time, _):
+        self.tuner.add_producer_time(time.perf_counter() - start_time)
+
+    def _run_batches_from_queue(self):
+        while not self._stop_flag:
+            item = self._get_from_queue(self._prefetch_queue)
+            if item is None:
+                self._put_into_queue(self._batch_queue, None)
+                break
+            future, state, reserved = item
+            try:
+                batch = future.result()
+            except SkipBatchException:
+                self.run_stats['skipped'] += 1
+                # release the prefetch slot, so that another batch is prefetched instead of the skipped one
+                self._release_memory(reserved, reserved=True)
+                self._get_from_queue(self._prefetch_count)
+            except Exception as exc:   # pylint: disable=broad-except
+                self.run_stats['errors'] += 1
+                self._release_memory(reserved, reserved=True)
+                self._put_into_queue(self._batch_queue, (None, state, exc, 0))
+                break
+            else:
+                nbytes = 0
+                if self.memory_budget is not None:
+                    nbytes = self.memory_budget.commit(reserved, batch_nbytes(batch))
+                self._put_into_queue(self._batch_queue, (batch, state, None, nbytes))
@@ -0,0 +1,238 @@
+""" Contains a streaming rebatcher """
+from collections import deque
+import numpy as np
+
+from .dsindex import DatasetIndex
+
+
+def has_default_merge(batch_class):
+    """ Check if a batch class uses `merge` from this package rather than its own implementation """
+    for cls in batch_class.__mro__:
+        if 'merge' in cls.__dict__:
+            return cls.__module__.rsplit('.', 1)[0] == __name__.rsplit('.', 1)[0]
+    return False
+
+
+def slice_batch(batch, start):
+    """ Return a batch with items from a given position to the end (data are shared with the batch) """
+    if start == 0:
+        return batch
+    data = [type(batch).slice_component(comp, batch.get(component=comp), start, len(batch), batch.indices)
+            for comp in batch.components or (None,)]
+    new_batch = type(batch)(DatasetIndex(np.arange(len(batch) - start)))
+    # put the data directly to avoid copying it once more with load()
+    new_batch._data = tuple(data) if batch.components is not None else data[0]   # pylint: disable=protected-access
+    return new_batch
+
+
+class Rebatcher:
+    """ Collect items from incoming batches into batches of a fixed size
+
+    Array components are copied straight into preallocated arrays of the target batch size,
+    so each item is copied once, no matter how many incoming batches are needed to fill a batch.
+    Other components (e.g. lists, dicts or data frames) are sliced and merged with `slice_component`
+    and `merge_component` of the batch class.
+
+    Args:
+        batch_size: int - the size of output batches
+
+    Usage:
+        rebatcher = Rebatcher(256)
+        for batch in small_batches:
+            for big_batch in rebatcher.put(batch):
+                ...
+        last_batch = rebatcher.flush()
+    """
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.batch_class = None
+        self.components = None
+        self._buffers = None
+        self._fill = 0
+
+    def __len__(self):
+        """ The number of items waiting for the next batch """
+        return self._fill
+
+    @staticmethod
+    def _get_components(batch):
+        return batch.components or (None,)
+
+    def _new_buffers(self, batch):
+        buffers = []
+        for comp in self.components:
+            data = batch.get(component=comp)
+            if isinstance(data, np.ndarray):
+                buffers.append(np.empty((self.batch_size,) + data.shape[1:], dtype=data.dtype))
+            else:
+                buffers.append([])
+        return buffers
+
+    def put(self, batch):
+        """ Add items from a batch and return a list of filled batches """
+        if self.batch_class is None:
+            self.batch_class = type(batch)
+            self.components = self._get_components(batch)
+        new_batches = []
+        data = [batch.get(component=comp) for comp in self.components]
+        start = 0
+        while start < len(batch):
+            if self._buffers is None:
+                self._buffers = self._new_buffers(batch)
+            size = min(self.batch_size - self._fill, len(batch) - start)
+            for i, buffer in enumerate(self._buffers):
+                if isinstance(buffer, np.ndarray):
+                    buffer[self._fill:self._fill + size] = data[i][start:start + size]
+                else:
+                    buffer.append(self.batch_class.slice_component(self.components[i], data[i], start, start + size,
+                                                                   batch.indices))
+            self._fill += size
+            start += size
+            if self._fill == self.batch_size:
+                new_batches.append(self._make_batch(self._buffers))
+                self._buffers = None
+                self._fill = 0
+        return new_batches
+
+    def flush(self):
+        """ Return a batch with the rest of items or None if there are no items left """
+        if self._fill == 0:
+            return None
+        buffers = [buffer[:self._fill] if isinstance(buffer, np.ndarray) else buffer for buffer in self._buffers]
+        batch = self._make_batch(buffers)
+        self._buffers = None
+        self._fill = 0
+        return batch
+
+    def _make_batch(self, buffers):
+        data = []
+        for comp, buffer in zip(self.components, buffers):
+            if isinstance(buffer, np.ndarray):
+                data.append(buffer)
+            else:
+                data.append(self.batch_class.merge_component(comp, buffer))
+        size = len(data[0])
+        batch = self.batch_class(DatasetIndex(np.arange(size)))
+        # put the data directly to avoid copying it once more with load()
+        batch._data = tuple(data) if batch.components is not None else data[0]   # pylint: disable=protected-access
+        return batch
+
+
+class RebatchGenerator:
+    """ Generate batches of a fixed size from batches of another pipeline
+
+    Items are copied into preallocated batches with `Rebatcher`, while batches of classes with their own `merge`
+    (or any batches if `merge_fn` is given) are collected into a list and merged.
+    Items which have been taken from the pipeline but not returned yet are saved in the iteration state.
+    As returned batches might be changed in place (even before the state is taken, when batches are prefetched),
+    `get_state` just keeps references to incoming batches which are never changed here,
+    and `get_leftovers` makes batches of items which have not been returned from them.
+
+    Args:
+        pipeline: a pipeline to take batches from
+        batch_size: int - the size of output batches
+        merge_fn: callable or None - a function which takes a list of batches and `batch_size`
+                  and returns a batch and a batch with the rest of items (or None)
+    """
+    def __init__(self, pipeline, batch_size, merge_fn=None):
+        self.pipeline = pipeline
+        self.batch_size = batch_size
+        self.merge_fn = merge_fn
+        self._rest_batch = None
+        self._rebatcher = None
+        self._ready = deque()
+        # incoming batches with items which have not been returned yet, with positions of their first items
+        self._sources = deque()
+        self._n_taken = 0
+        self._n_returned = 0
+
+    def gen(self, *args, leftovers=None, **kwargs):
+        """ Generate batches
+        Args:
+            leftovers: list of batches with items left from a previous run
+            args, kwargs: arguments for `pipeline.next_batch`
+        """
+        leftovers = leftovers or []
+        if self.merge_fn is None:
+            yield from self._gen_streaming(leftovers, *args, **kwargs)
+        else:
+            yield from self._gen_merged(self.merge_fn, leftovers, *args, **kwargs)
+
+    def get_state(self):
+        """ Return a state to get items taken from the pipeline but not returned yet with `get_leftovers`
+        It only refers to incoming batches, so it is cheap to take it after each batch.
+        """
+        return tuple(self._sources), self._n_returned, self._rest_batch
+
+    @staticmethod
+    def get_leftovers(state):
+        """ Return a list of batches with items which have not been returned yet """
+        sources, n_returned, rest_batch = state
+        leftovers = [slice_batch(batch, max(n_returned - start, 0)) for start, batch in sources]
+        if rest_batch is not None:
+            leftovers.append(rest_batch)
+        return leftovers
+
+    def _put(self, batch):
+        """ Put an incoming batch into the rebatcher """
+        self._sources.append((self._n_taken, batch))
+        self._n_taken += len(batch)
+        self._ready.extend(self._rebatcher.put(batch))
+
+    def _returned(self, batch):
+        """ Count items of a batch which is going to be returned """
+        self._n_returned += len(batch)
+        while len(self._sources) > 0 and self._sources[0][0] + len(self._sources[0][1]) <= self._n_returned:
+            self._sources.popleft()
+        return batch
+
+    def _gen_merged(self, merge_fn, batches, *args, **kwargs):
+        """ Generate batches with a merge function starting with items of given batches """
+        batches = list(batches)
+        while True:
+            cur_len = sum(len(batch) for batch in batches)
+            while cur_len < self.batch_size:
+                try:
+                    new_batch = self.pipeline.next_batch(*args, **kwargs)
+                except StopIteration:
+                    break
+                else:
+                    batches.append(new_batch)
+                    cur_len += len(new_batch)
+            if len(batches) == 0:
+                break
+            batch, self._rest_batch = merge_fn(batches, batch_size=self.batch_size)
+            yield batch
+            batches = [self._rest_batch] if self._rest_batch is not None else []
+            self._rest_batch = None
+
+    def _gen_streaming(self, leftovers, *args, **kwargs):
+        """ Generate batches copying items into preallocated batches
+        If the batch class has its own `merge`, it is used instead.
+        """
+        if len(leftovers) > 0 and not has_default_merge(type(leftovers[0])):
+            yield from self._gen_merged(type(leftovers[0]).merge, leftovers, *args, **kwargs)
+            return
+        self._rebatcher = Rebatcher(self.batch_size)
+        for batch in leftovers:
+            self._put(batch)
+        while len(self._ready) > 0:
+            yield self._returned(self._ready.popleft())
+        while True:
+            try:
+                new_batch = self.pipeline.next_batch(*args, **kwargs)
+            except StopIteration:
+                break
+            if not has_default_merge(type(new_batch)):
+                # items left from a previous run are merged as well
+                rest_batch = self._rebatcher.flush()
+                self._sources.clear()
+                batches = [new_batch] if rest_batch is None else [rest_batch, new_batch]
+                yield from self._gen_merged(type(new_batch).merge, batches, *args, **kwargs)
+                return
+            self._put(new_batch)
+            while len(self._ready) > 0:
+                yield self._returned(self._ready.popleft())
+        batch = self._rebatcher.flush()
+        if batch is not None:
+            yield self._returned(batch)
@@ -0,0 +1,165 @@
+""" Contains a server for online inference with micro-batching """
+import time
+import threading
+import concurrent.futures as cf
+import queue as q
+from collections import deque
+import numpy as np
+
+
+class InferenceServer:
+    """ Run a pipeline over items which arrive one at a time
+
+    Items are collected into micro-batches of up to `batch_size` items (or whatever has arrived
+    within `timeout` seconds after the first item), all pipeline actions are executed for each batch
+    and every item gets its own result back.
+
+    Args:
+        pipeline: a pipeline with actions to execute (including actions with models)
+        batch_size: int - the maximum number of items in a batch
+        timeout: float - how long to wait for more items before running an incomplete batch (in seconds)
+        batch_class: a batch class to create batches from items (a pipeline dataset batch class if None)
+        collate: callable - a function which takes a list of items and returns batch data.
+                 By default items are stacked with numpy (each component separately if items are tuples).
+        get_result: callable - a function which takes a processed batch and returns a sequence of item results.
+                    By default it is `[batch[ix] for ix in batch.indices]`.
+        n_latencies: int - how many recent latencies to keep for statistics
+
+    Usage:
+        with InferenceServer(predict_pipeline, batch_size=16, timeout=0.005) as server:
+            prediction = server.predict(item)
+            future = server.submit(another_item)
+            ...
+            print(server.stats())
+    """
+    def __init__(self, pipeline, *, batch_size=32, timeout=0.01, batch_class=None, collate=None, get_result=None,
+                 n_latencies=10000):
+        self.pipeline = pipeline
+        self.batch_size = batch_size
+        self.timeout = timeout
+        if batch_class is None:
+            if pipeline.dataset is None:
+                raise ValueError("batch_class should be specified for a pipeline without a dataset")
+            batch_class = pipeline.dataset.batch_class
+        self.batch_class = batch_class
+        self.collate = collate or self.collate_items
+        self.get_result = get_result or self.get_item_results
+
+        self._queue = q.Queue()
+        self._worker = None
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=n_latencies)
+        self._n_items = 0
+        self._n_batches = 0
+        self._n_errors = 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, trback):
+        self.stop()
+
+    @staticmethod
+    def collate_items(items):
+        """ Stack items into batch data """
+        if isinstance(items[0], tuple):
+            return tuple(np.asarray([item[i] for item in items]) for i in range(len(items[0])))
+        return np.asarray(items)
+
+    @staticmethod
+    def get_item_results(batch):
+        """ Return a result for each item in the batch """
+        return [batch[ix] for ix in batch.indices]
+
+    def start(self):
+        """ Start processing items in a background thread """
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._serve, daemon=True)
+            self._worker.start()
+        return self
+
+    def stop(self):
+        """ Stop the server after all submitted items have been processed """
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+        return self
+
+    def submit(self, item):
+        """ Put an item into the queue
+        Return:
+            concurrent.futures.Future which will hold the result for the item
+        """
+        if self._worker is None:
+            raise RuntimeError("The server is not running. Call start() first")
+        future = cf.Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def predict(self, item, timeout=None):
+        """ Process one item and wait for its result """
+        return self.submit(item).result(timeout=timeout)
+
+    def _get_requests(self):
+        """ Collect requests for the next batch """
+        request = self._queue.get()
+        if request is None:
+            return None
+        requests = [request]
+        deadline = time.perf_counter() + self.timeout
+        while len(requests) < self.batch_size:
+            wait = deadline - time.perf_counter()
+            try:
+                request = self._queue.get(timeout=wait) if wait > 0 else self._queue.get_nowait()
+            except q.Empty:
+                break
+            if request is None:
+                # stop after the current batch
+                self._queue.put(None)
+                break
+            requests.append(request)
+        return requests
+
+    def _serve(self):
+        while True:
+            requests = self._get_requests()
+            if requests is None:
+                break
+            self._process(requests)
+
+    def _process(self, requests):
+        items, futures, start_times = zip(*requests)
+        try:
+            batch = self.batch_class.from_data(np.arange(len(items)), self.collate(list(items)))
+            batch = self.pipeline.execute_for(batch)
+            results = self.get_result(batch)
+        except Exception as exc:   # pylint: disable=broad-except
+            for future in futures:
+                future.set_exception(exc)
+            n_errors = len(futures)
+        else:
+            for future, result in zip(futures, results):
+                future.set_result(result)
+            n_errors = 0
+
+        end_time = time.perf_counter()
+        with self._stats_lock:
+            self._latencies.extend(end_time - start_time for start_time in start_times)
+            self._n_items += len(requests)
+            self._n_batches += 1
+            self._n_errors += n_errors
+
+    def stats(self, percentiles=(50, 90, 99)):
+        """ Return serving statistics
+        Return:
+            a dict with the number of items, batches and errors, a mean batch size
+            and latency percentiles (in seconds) over recent items
+        """
+        with self._stats_lock:
+            latencies = np.asarray(self._latencies)
+            res = dict(items=self._n_items, batches=self._n_batches, errors=self._n_errors,
+                       mean_batch_size=self._n_items / self._n_batches if self._n_batches > 0 else 0.)
+        for pct in percentiles:
+            res['p%s' % pct] = np.percentile(latencies, pct) if len(latencies) > 0 else None
+        return res
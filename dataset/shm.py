@@ -0,0 +1,130 @@
+""" Contains tools to run in-batch parallel actions in worker processes over shared memory """
+import threading
+import multiprocessing as mp
+import concurrent.futures as cf
+import numpy as np
+
+from .tuning import cpu_count
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+
+_SHM_EXECUTOR = None
+_SHM_EXECUTOR_LOCK = threading.Lock()
+
+
+def _get_mp_context():
+    # forking from a process with many threads (e.g. prefetching) might hang, so workers are started
+    # from a clean server process (or a fresh interpreter where there is no forkserver)
+    methods = mp.get_all_start_methods()
+    return mp.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def get_executor(n_workers):
+    """ Return a process pool which is kept between calls, so that workers are started only once
+
+    The pool has at least `n_workers` workers, while callers bound the number of their running tasks themselves.
+    A pool is never shut down here as other calls might still use it. When a larger pool is needed,
+    the old one is just dropped and its workers stop when all calls which use it have finished.
+    """
+    global _SHM_EXECUTOR     # pylint: disable=global-statement
+    with _SHM_EXECUTOR_LOCK:
+        # pylint: disable=protected-access
+        if _SHM_EXECUTOR is None or _SHM_EXECUTOR._max_workers < n_workers or _SHM_EXECUTOR._broken:
+            n_workers = max(n_workers, cpu_count(), _SHM_EXECUTOR._max_workers if _SHM_EXECUTOR else 0)
+            _SHM_EXECUTOR = cf.ProcessPoolExecutor(max_workers=n_workers, mp_context=_get_mp_context())
+        return _SHM_EXECUTOR
+
+
+def is_shareable(data):
+    """ Check if data can be put into shared memory """
+    return isinstance(data, np.ndarray) and not data.dtype.hasobject and data.nbytes > 0
+
+
+class SharedArray:
+    """ A numpy array in shared memory which is created in the main process and attached in workers
+
+    Args:
+        shape: tuple - array shape
+        dtype: array dtype
+        data: np.ndarray or None - data to copy into the array
+
+    Only `spec` (a name, a shape and a dtype) is sent to workers, which call `attach` to get the array.
+    """
+    def __init__(self, shape, dtype, data=None):
+        if shared_memory is None:
+            raise ImportError("Shared memory requires Python 3.8 or higher")
+        dtype = np.dtype(dtype)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+        self.spec = (self._shm.name, tuple(shape), dtype.str)
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf)
+        if data is not None:
+            self.array[...] = data
+
+    @staticmethod
+    def attach(spec):
+        """ Return a shared memory block and an array in it """
+        name, shape, dtype = spec
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)   # pylint: disable=unexpected-keyword-arg
+        except TypeError:
+            # before Python 3.13 an attached block is registered again in the resource tracker
+            # which pool workers share with the main process, so it is still unlinked only once
+            shm = shared_memory.SharedMemory(name=name)
+        return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    def close(self):
+        """ Free shared memory """
+        self.array = None
+        self._shm.close()
+        self._shm.unlink()
+
+
+def run_chunk(job, positions, item_args):
+    """ Call a function for items at given positions in a worker process
+
+    Args:
+        job: dict - a function, specs of shared input arrays (or other data as is) and of an output array
+        positions: list of int - item positions within the batch
+        item_args: list of tuples - args and kwargs for each item
+
+    Return:
+        a list of results (None for results written into the output array) or exceptions
+    """
+    blocks = []
+    try:
+        inputs = []
+        for kind, value in job['inputs']:
+            if kind == 'shm':
+                shm, value = SharedArray.attach(value)
+                blocks.append(shm)
+            inputs.append(value)
+        output = None
+        if job['output'] is not None:
+            shm, output = SharedArray.attach(job['output'])
+            blocks.append(shm)
+
+        results = []
+        for pos, (args, kwargs) in zip(positions, item_args):
+            try:
+                item = tuple(data[pos] if data is not None else None for data in inputs)
+                item = item[0] if job['single'] else item
+                result = job['func'](item, *args, **kwargs)
+                if output is not None:
+                    output[pos] = result
+                    result = None
+                elif isinstance(result, np.ndarray) and not result.flags.owndata:
+                    # a view might point to shared memory which is closed before results are sent back
+                    result = np.array(result)
+            except Exception as exc:   # pylint: disable=broad-except
+                result = exc
+            results.append(result)
+        return results
+    finally:
+        # shared memory cannot be closed while arrays use it
+        inputs, output, item, value = None, None, None, None
+        for shm in blocks:
+            shm.close()
@@ -0,0 +1,327 @@
+""" Contains tools which adjust and bound parallelism at runtime """
+import os
+import time
+import math
+import queue as q
+import threading
+import contextlib
+
+
+def cpu_count():
+    """ Return the number of CPUs available to the current process """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
+
+
+class SlotQueue(q.Queue):
+    """ A queue which maximum size might be changed while it is used """
+    def resize(self, maxsize):
+        """ Set a new maximum size (items already in the queue are kept) """
+        with self.mutex:
+            self.maxsize = maxsize
+            self.not_full.notify_all()
+
+
+class ConcurrencyBudget:
+    """ A limit on the number of threads which run at the same time across all kinds of parallelism
+
+    Prefetching workers take a slot for each batch (waiting for it if there are none).
+    Parallel in-batch actions get as many extra slots as are free right now (never waiting for them),
+    while the thread which runs an action lends its own slot to the action workers.
+    Thus nested parallelism cannot deadlock and the number of busy threads stays close to the limit.
+
+    Args:
+        n_threads: int - the number of slots (the number of CPUs if None)
+    """
+    def __init__(self, n_threads=None):
+        self.n_threads = n_threads or cpu_count()
+        self.active = 0
+        self.peak_active = 0
+        self.wait_time = 0.
+        self._cond = threading.Condition()
+
+    def _take(self, n_slots):
+        self.active += n_slots
+        self.peak_active = max(self.peak_active, self.active)
+
+    def acquire(self):
+        """ Wait for a free slot and take it """
+        start_time = time.perf_counter()
+        with self._cond:
+            self._cond.wait_for(lambda: self.active < self.n_threads)
+            self._take(1)
+            self.wait_time += time.perf_counter() - start_time
+
+    def try_acquire(self, n_slots):
+        """ Take up to `n_slots` free slots without waiting
+        Return:
+            the number of slots taken
+        """
+        with self._cond:
+            n_slots = max(0, min(n_slots, self.n_threads - self.active))
+            self._take(n_slots)
+        return n_slots
+
+    def release(self, n_slots=1):
+        """ Return slots """
+        if n_slots > 0:
+            with self._cond:
+                self.active -= n_slots
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """ Run a block of code in a slot """
+        self.acquire()
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def stats(self):
+        """ Return a dict with the limit, the current and the peak number of busy slots and total wait time """
+        return dict(n_threads=self.n_threads, active=self.active, peak_active=self.peak_active,
+                    wait_time=self.wait_time)
+
+
+_CONCURRENCY_BUDGET = None
+
+
+def set_concurrency_budget(n_threads='auto'):
+    """ Limit the number of threads which run batches and parallel actions at the same time
+
+    Args:
+        n_threads: int - the number of threads, 'auto' - the number of CPUs, None - no limit
+
+    Return:
+        ConcurrencyBudget or None
+    """
+    global _CONCURRENCY_BUDGET     # pylint: disable=global-statement
+    _CONCURRENCY_BUDGET = None if n_threads is None else ConcurrencyBudget(None if n_threads == 'auto' else n_threads)
+    return _CONCURRENCY_BUDGET
+
+
+def get_concurrency_budget():
+    """ Return the current concurrency budget or None if there is no limit """
+    return _CONCURRENCY_BUDGET
+
+
+class MemoryBudget:
+    """ Track the size of data in memory and make producers wait while it exceeds a limit
+
+    Producers reserve memory before creating data. As the size is not known in advance,
+    the reservation is the mean size of data seen so far and it is corrected when the actual size is known.
+    Until the first size is known, only one reservation is allowed at a time.
+    One reservation is always allowed, so that data larger than the limit do not block forever.
+
+    Args:
+        max_bytes: int - the limit in bytes
+
+    Usage:
+        budget = MemoryBudget(2**30)
+        reserved = budget.reserve()
+        data = make_data()
+        nbytes = budget.commit(reserved, get_size(data))
+        ...
+        budget.release(nbytes)
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.peak_nbytes = 0
+        self._n_items = 0
+        self._total_nbytes = 0
+        self._n_reserved = 0
+        self._cond = threading.Condition()
+
+    def _estimate(self):
+        return self._total_nbytes // self._n_items if self._n_items > 0 else 0
+
+    def _add(self, nbytes):
+        self.nbytes += nbytes
+        self.peak_nbytes = max(self.peak_nbytes, self.nbytes)
+        if nbytes < 0:
+            self._cond.notify_all()
+
+    def _fits(self):
+        if self._n_items == 0:
+            return self._n_reserved == 0
+        return self.nbytes == 0 or self.nbytes + self._estimate() <= self.max_bytes
+
+    def reserve(self, timeout=None):
+        """ Wait until expected data fit into the limit and reserve memory for them
+        Return:
+            the number of reserved bytes or None if the limit is still exceeded after `timeout` seconds
+        """
+        with self._cond:
+            if not self._cond.wait_for(self._fits, timeout):
+                return None
+            estimate = self._estimate()
+            self._n_reserved += 1
+            self._add(estimate)
+            return estimate
+
+    def commit(self, reserved, nbytes):
+        """ Replace a reservation with the actual size of data
+        Return:
+            nbytes
+        """
+        with self._cond:
+            self._n_items += 1
+            self._total_nbytes += nbytes
+            self._n_reserved -= 1
+            self._add(nbytes - reserved)
+            self._cond.notify_all()
+        return nbytes
+
+    def cancel(self, reserved):
+        """ Free reserved memory when data have not been created """
+        with self._cond:
+            self._n_reserved -= 1
+            self._add(-reserved)
+            self._cond.notify_all()
+
+    def release(self, nbytes):
+        """ Free memory taken by data or reserved for them """
+        with self._cond:
+            self._add(-nbytes)
+
+    def stats(self):
+        """ Return a dict with the current and the peak size of data in bytes """
+        return dict(nbytes=self.nbytes, peak_nbytes=self.peak_nbytes)
+
+
+class PrefetchTuner:
+    """ Adjust prefetch depth from how long the consumer waits for batches and how long batches take to process
+
+    The depth grows while the consumer spends a noticeable share of its time waiting for batches.
+    It shrinks when the consumer does not wait at all and fewer batches in progress are enough
+    to cover the batch processing time (by Little's law, depth = processing time / consumer time per batch).
+
+    Args:
+        depth: int - an initial depth
+        max_depth: int - the maximum depth
+        window: int - how many batches to measure before changing the depth
+        max_wait: float - which share of consumer time might be spent waiting without increasing the depth
+    """
+    def __init__(self, depth=1, max_depth=None, window=10, max_wait=0.05):
+        self.max_depth = max_depth or cpu_count()
+        self.depth = max(1, min(depth, self.max_depth))
+        self.max_depth_used = self.depth
+        self.window = window
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._n_batches = 0
+        self._wait_time = 0.
+        self._busy_time = 0.
+        self._producer_time = 0.
+        self._n_produced = 0
+
+    def add_producer_time(self, elapsed):
+        """ Add time of processing one batch """
+        with self._lock:
+            self._producer_time += elapsed
+            self._n_produced += 1
+
+    def update(self, wait_time, busy_time):
+        """ Add time which the consumer waited for a batch and spent on it
+        Return:
+            a new depth
+        """
+        with self._lock:
+            self._n_batches += 1
+            self._wait_time += wait_time
+            self._busy_time += busy_time
+            if self._n_batches >= self.window:
+                self.depth = self._next_depth()
+                self.max_depth_used = max(self.max_depth_used, self.depth)
+                self._reset()
+            return self.depth
+
+    def _next_depth(self):
+        consumer_time = self._wait_time + self._busy_time
+        if self._wait_time > self.max_wait * consumer_time:
+            return min(self.depth + 1, self.max_depth)
+        if self._wait_time == 0 and self._n_produced > 0 and self._busy_time > 0:
+            producer_time = self._producer_time / self._n_produced
+            needed = math.ceil(producer_time / (self._busy_time / self._n_batches))
+            if needed < self.depth:
+                return max(self.depth - 1, 1)
+        return self.depth
+
+    def stats(self):
+        """ Return a dict with the current and the maximum depth """
+        return dict(depth=self.depth, max_depth=self.max_depth_used)
+
+
+class WorkerTuner:
+    """ Find the number of workers with the highest throughput
+
+    It starts with the number of CPUs, measures items per second over a few calls,
+    then tries twice as many and half as many workers and moves towards the best one.
+    After finding the best number it measures again every `recheck` calls, as the load might change.
+
+    Args:
+        n_workers: int - an initial number of workers
+        max_workers: int - the maximum number of workers
+        window: int - how many calls to measure for each number of workers
+        recheck: int - how many calls to make with the best number before measuring again
+    """
+    def __init__(self, n_workers=None, max_workers=None, window=3, recheck=100):
+        self.max_workers = max_workers or cpu_count() * 4
+        self.n_workers = max(1, min(n_workers or cpu_count(), self.max_workers))
+        self.window = window
+        self.recheck = recheck
+        self._lock = threading.Lock()
+        self._rates = dict()
+        self._converged_calls = None
+
+    def get(self):
+        """ Return the number of workers for the next call """
+        return self.n_workers
+
+    def update(self, n_workers, n_items, elapsed):
+        """ Add time which a call with a given number of workers took to process items """
+        with self._lock:
+            if self._converged_calls is not None:
+                self._converged_calls += 1
+                if self._converged_calls >= self.recheck:
+                    self._rates = dict()
+                    self._converged_calls = None
+                return
+            if n_workers != self.n_workers:
+                # a call which started before the number of workers changed
+                return
+            stats = self._rates.setdefault(n_workers, [0, 0., 0])
+            stats[0] += n_items
+            stats[1] += elapsed
+            stats[2] += 1
+            if stats[2] >= self.window:
+                self.n_workers = self._next_workers()
+
+    def _rate(self, n_workers):
+        stats = self._rates.get(n_workers)
+        if stats is None or stats[2] < self.window:
+            return None
+        return stats[0] / stats[1] if stats[1] > 0 else math.inf
+
+    def _next_workers(self):
+        # try untested neighbours of the best number of workers so far
+        measured = [n_workers for n_workers in self._rates if self._rate(n_workers) is not None]
+        best = max(measured, key=self._rate)
+        for n_workers in (best * 2, best // 2):
+            if 1 <= n_workers <= self.max_workers and self._rate(n_workers) is None:
+                return n_workers
+        self._converged_calls = 0
+        return best
+
+    def stats(self):
+        """ Return a dict with the current number of workers and measured throughput (items per second) """
+        with self._lock:
+            rates = {n_workers: self._rate(n_workers) for n_workers in self._rates}
+        return dict(n_workers=self.n_workers, rates=rates, converged=self._converged_calls is not None)
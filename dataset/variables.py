@@ -0,0 +1,168 @@
+""" Contains pipeline variables with atomic updates """
+import threading
+import itertools
+import numpy as np
+
+
+class ShardedVariable:
+    """ Base class for a variable which is updated from many threads
+
+    Each thread updates its own shard without any locks, while shards are merged on read.
+    Child classes define how to create, update and merge shards.
+
+    Args:
+        value - an initial value
+    """
+    def __init__(self, value=None):
+        self._value = value
+        self._shards = dict()
+        self._lock = threading.Lock()
+
+    def _new_shard(self):
+        raise NotImplementedError()
+
+    def _update_shard(self, shard, value):
+        raise NotImplementedError()
+
+    def _merge(self, value, shards):
+        raise NotImplementedError()
+
+    def _get_shard(self):
+        thread_id = threading.get_ident()
+        shard = self._shards.get(thread_id)
+        if shard is None:
+            with self._lock:
+                shard = self._shards.setdefault(thread_id, self._new_shard())
+        return shard
+
+    def update(self, value):
+        """ Update the variable with a value from the current thread """
+        self._update_shard(self._get_shard(), value)
+
+    def get(self):
+        """ Return the merged value """
+        with self._lock:
+            shards = list(self._shards.values())
+        return self._merge(self._value, shards)
+
+    def set(self, value):
+        """ Drop all updates and set a new value """
+        with self._lock:
+            self._value = value
+            self._shards = dict()
+
+    def __getstate__(self):
+        return {'value': self.get()}
+
+    def __setstate__(self, state):
+        self.__init__(state['value'])
+
+
+class SumVariable(ShardedVariable):
+    """ A variable which accumulates a sum of all updates """
+    def _new_shard(self):
+        return [0]
+
+    def _update_shard(self, shard, value):
+        shard[0] += value
+
+    def _merge(self, value, shards):
+        res = value if value is not None else 0
+        for shard in shards:
+            res = res + shard[0]
+        return res
+
+
+class ListVariable(ShardedVariable):
+    """ A variable which appends all updates to a list (in the order of updates) """
+    _counter = itertools.count()
+
+    def _new_shard(self):
+        return []
+
+    def _update_shard(self, shard, value):
+        # itertools.count is atomic, so updates from different threads can be ordered on merge
+        shard.append((next(self._counter), value))
+
+    def _merge(self, value, shards):
+        items = sorted(itertools.chain(*shards), key=lambda item: item[0])
+        return list(value or []) + [item for _, item in items]
+
+
+class MaxVariable(ShardedVariable):
+    """ A variable which keeps the maximum of all updates """
+    def _new_shard(self):
+        return [None]
+
+    def _better(self, first, second):
+        return first > second
+
+    def _update_shard(self, shard, value):
+        if shard[0] is None or self._better(value, shard[0]):
+            shard[0] = value
+
+    def _merge(self, value, shards):
+        res = value
+        for shard in shards:
+            if shard[0] is not None and (res is None or self._better(shard[0], res)):
+                res = shard[0]
+        return res
+
+
+class MinVariable(MaxVariable):
+    """ A variable which keeps the minimum of all updates """
+    def _better(self, first, second):
+        return first < second
+
+
+class SampleVariable(ShardedVariable):
+    """ A variable which keeps a uniform random sample of all updates (reservoir sampling)
+
+    Args:
+        value - an initial list of items
+        size: int - the maximum number of items in the sample
+    """
+    def __init__(self, value=None, size=100):
+        self.size = size
+        super().__init__(value)
+
+    def _new_shard(self):
+        return dict(items=[], count=0, random=np.random.RandomState())
+
+    def _update_shard(self, shard, value):
+        shard['count'] += 1
+        if len(shard['items']) < self.size:
+            shard['items'].append(value)
+        else:
+            pos = shard['random'].randint(shard['count'])
+            if pos < self.size:
+                shard['items'][pos] = value
+
+    def _merge(self, value, shards):
+        items, weights = list(value or []), [1.] * len(value or [])
+        for shard in shards:
+            shard_items = list(shard['items'])
+            if len(shard_items) > 0:
+                items += shard_items
+                weights += [shard['count'] / len(shard_items)] * len(shard_items)
+        if len(items) <= self.size:
+            return items
+        weights = np.asarray(weights) / np.sum(weights)
+        positions = np.random.choice(len(items), size=self.size, replace=False, p=weights)
+        return [items[pos] for pos in np.sort(positions)]
+
+    def __getstate__(self):
+        return {'value': self.get(), 'size': self.size}
+
+    def __setstate__(self, state):
+        self.__init__(state['value'], state['size'])
+
+
+VARIABLE_OPS = dict(add=SumVariable, append=ListVariable, max=MaxVariable, min=MinVariable, sample=SampleVariable)
+
+
+def make_variable(op, value=None, **kwargs):
+    """ Create a sharded variable for a given update operation: 'add', 'append', 'max', 'min' or 'sample' """
+    if op not in VARIABLE_OPS:
+        raise ValueError("op should be one of %s" % list(VARIABLE_OPS))
+    return VARIABLE_OPS[op](value, **kwargs)